@@ -1,88 +1,84 @@
-from flask import Flask, request, jsonify, send_from_directory
-import os
-import sqlite3
+from flask import Flask, Request, request, jsonify, send_file, send_from_directory, current_app, url_for, g
 import hashlib
-import urllib.request
-import re
+import json
+import mimetypes
+import os
+import urllib.parse
+import tarfile
+import zipfile
+import batch
+import blobstore
+import ingest
+import metrics
+import similarity
+from streaming import HashingSpoolFile
+from storage import get_storage, normalize_timestamp
+from cache import LRUCache
+from lookup_cache import CachedStorage
+from duplicate_check import store_new_file
+
+
+class HashingRequest(Request):
+    """Request that hashes uploaded files while spooling them to disk."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Spool next to the blobs so storing new content is a same-disk rename
+        spool = HashingSpoolFile(current_app.config["BLOB_FOLDER"])
+        self.__dict__.setdefault("_spools", []).append(spool)
+        return spool
+
 
 app = Flask(__name__, static_folder="../frontend", static_url_path="")
+app.request_class = HashingRequest
+# Files stored before the content-addressed blob store; read-only now
 UPLOAD_FOLDER = "./static/uploads"
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+BLOB_FOLDER = blobstore.BLOB_FOLDER
+app.config["BLOB_FOLDER"] = BLOB_FOLDER
 ALLOWED_EXTENSIONS = {'pdf', 'jpg', 'jpeg', 'png', 'mp3', 'xlsx', 'xls', 'txt'}
-
-# Database initialization
-DB_PATH = "files.db"
-
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_db():
-    """Initialize the SQLite database."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS files (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        file_name TEXT UNIQUE,
-        file_path TEXT,
-        file_hash TEXT UNIQUE,
-        uploaded_by TEXT,
-        url TEXT
-    )
-    """)
-    
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS downloads (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        file_name TEXT,
-        user_id TEXT,
-        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (file_name) REFERENCES files(file_name)
-    )
-    """)
-    
-    conn.commit()
-    conn.close()
-
-def calculate_file_hash(file_path):
-    """Calculate SHA256 hash of the file."""
-    hash_sha256 = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_sha256.update(chunk)
-    return hash_sha256.hexdigest()
-
-def check_duplicate(file_hash):
-    """Check if a file with the same hash exists."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM files WHERE file_hash = ?", (file_hash,))
-    duplicate = cursor.fetchone()
-    conn.close()
-    return duplicate
-
-def add_file_to_db(file_name, file_path, file_hash, user_id, url=None):
-    """Insert file metadata into the database."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO files (file_name, file_path, file_hash, uploaded_by, url) 
-        VALUES (?, ?, ?, ?, ?)""",
-        (file_name, file_path, file_hash, user_id, url)
-    )
-    conn.commit()
-    conn.close()
-
-def log_download(file_name, user_id):
-    """Log user downloads."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO downloads (file_name, user_id) VALUES (?, ?)", (file_name, user_id))
-    conn.commit()
-    conn.close()
+DEFAULT_PAGE_SIZE = 100
+
+# How file bytes leave the server: "" streams from the worker (zero-copy via
+# the WSGI server's file wrapper where supported), "x-sendfile" hands the
+# path to Apache/lighttpd, "x-accel" hands an internal URI to nginx.
+SENDFILE_MODE = os.getenv("DDAS_SENDFILE_MODE", "")
+app.config["USE_X_SENDFILE"] = SENDFILE_MODE == "x-sendfile"
+# nginx "internal" location that maps to X_ACCEL_ROOT for x-accel mode;
+# by default the directory holding the blob store
+X_ACCEL_PREFIX = os.getenv("DDAS_X_ACCEL_PREFIX", "/protected/")
+X_ACCEL_ROOT = os.getenv("DDAS_X_ACCEL_ROOT", os.path.dirname(os.path.normpath(BLOB_FOLDER)))
+# Internal location for legacy UPLOAD_FOLDER files outside X_ACCEL_ROOT
+X_ACCEL_UPLOADS_PREFIX = os.getenv("DDAS_X_ACCEL_UPLOADS_PREFIX", "/protected-uploads/")
+
+# Serialized /get_files pages keyed by (catalog version, filters)
+listing_cache = LRUCache(maxsize=256)
+
+@app.before_request
+def start_metrics():
+    if metrics.METRICS_ENABLED:
+        metrics.start_request(request.url_rule.rule if request.url_rule else "unmatched")
+    if metrics.PROFILING_ENABLED and (request.headers.get("X-DDAS-Profile") == "1" or request.args.get("profile") == "1"):
+        g.profiler = metrics.SamplingProfiler().start()
+
+@app.after_request
+def finish_metrics(response):
+    profiler = g.pop("profiler", None)
+    if profiler:
+        profiler.stop()
+        response.headers["X-DDAS-Profile"] = os.path.basename(profiler.write(request.path))
+    if metrics.METRICS_ENABLED:
+        timings = metrics.finish_request(request.method, response.status_code)
+        if metrics.SERVER_TIMING_ENABLED and timings:
+            response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
+
+@app.teardown_request
+def discard_spooled_uploads(exc):
+    """Remove spooled uploads that were not moved into place."""
+    for spool in request.__dict__.get("_spools", []):
+        spool.discard()
+    # Requests that never reached after_request
+    metrics.finish_request(request.method, 500)
 
 @app.route("/") 
 def serve_frontend():
@@ -90,28 +86,130 @@ def serve_frontend():
 
 @app.route("/upload", methods=["POST"]) 
 def upload_file():
-    file = request.files.get("file")
-    user_id = request.form.get("user_id")
+    # Parsing the form reads and hashes the whole body
+    with metrics.phase("receive"):
+        file = request.files.get("file")
+        user_id = request.form.get("user_id")
 
     if not file or not user_id:
         return jsonify({"error": "File and user ID are required"}), 400
 
-    file_path = os.path.join(UPLOAD_FOLDER, file.filename)
-    file.save(file_path)
+    # The body was hashed while it was being spooled, so the digest is
+    # final here and duplicates are rejected without another disk pass.
+    file_hash = file.stream.hexdigest()
+    file_name = os.path.basename(file.filename)
+
+    signature = similarity.spool_signature(file.stream, file_name)
+    allow_near_duplicate = request.form.get("allow_near_duplicate") == "true"
+
+    storage = get_storage()
+    # The near-duplicate check is advisory and read-only, so its bucket scan
+    # runs before the write lock instead of serializing every upload behind it
+    near_duplicate = None
+    if signature and not allow_near_duplicate:
+        with metrics.phase("lookup"):
+            if not storage.find_by_hash(file_hash):
+                near_duplicate = similarity.find_near_duplicate(storage, *signature)
+
+    with storage.transaction(immediate=True):
+        with metrics.phase("lookup"):
+            # Check for duplicate
+            duplicate = storage.find_by_hash(file_hash)
+            if duplicate:
+                return jsonify({
+                    "message": "Duplicate file detected",
+                    "uploaded_by": duplicate["uploaded_by"]
+                }), 409
+
+            if near_duplicate:
+                record, score = near_duplicate
+                return jsonify({
+                    "message": "Near-duplicate file detected",
+                    "similar_to": record["file_name"],
+                    "similarity": round(score, 3),
+                    "uploaded_by": record["uploaded_by"]
+                }), 409
+
+            # File names are unique metadata pointing at a blob
+            if storage.find_by_name(file_name):
+                return jsonify({"error": "A different file with this name already exists"}), 409
+
+        with metrics.phase("write"):
+            if not store_new_file(file.stream, file_name, file_hash, BLOB_FOLDER, signature, user_id=user_id):
+                # A concurrent upload stored the same content first
+                duplicate = storage.find_by_hash(file_hash)
+                return jsonify({
+                    "message": "Duplicate file detected",
+                    "uploaded_by": duplicate["uploaded_by"] if duplicate else "Unknown"
+                }), 409
+    return jsonify({"message": "File uploaded successfully"})
 
-    file_hash = calculate_file_hash(file_path)
+@app.route("/upload_batch", methods=["POST"])
+def upload_batch():
+    """
+    Upload many files in one request, either as repeated "files" parts or
+    as a single zip/tar "archive" part. Returns a per-file report.
+    """
+    with metrics.phase("receive"):
+        user_id = request.form.get("user_id")
+        parts = request.files.getlist("files")
+        archive = request.files.get("archive")
+
+    if not (parts or archive) or not user_id:
+        return jsonify({"error": "Files or an archive and user ID are required"}), 400
+
+    files = [(part.filename, part.stream) for part in parts]
+    if archive:
+        try:
+            with metrics.phase("receive"):
+                members = batch.extract_archive(archive.stream.name, BLOB_FOLDER)
+        except (zipfile.BadZipFile, tarfile.TarError):
+            return jsonify({"error": "Archive must be a zip or tar file"}), 400
+        except batch.ArchiveLimitError as e:
+            return jsonify({"error": str(e)}), 400
+        request.__dict__.setdefault("_spools", []).extend(spool for _, spool in members)
+        files.extend(members)
+
+    reports = batch.upload_batch(files, user_id, BLOB_FOLDER)
+    return jsonify({
+        "uploaded": sum(report["status"] == "uploaded" for report in reports),
+        "duplicates": sum(report["status"] == "duplicate" for report in reports),
+        "files": reports
+    })
+
+@app.route("/check", methods=["POST"])
+def check_file():
+    """
+    Pre-flight duplicate check so clients can skip uploading known content.
+    Accepts the full SHA-256 (authoritative) or the size plus sample
+    fingerprint, which can only flag a candidate that needs the full hash.
+    """
+    data = request.json or {}
+    file_hash = data.get("file_hash")
+    file_size = data.get("file_size")
+    sample_hash = data.get("sample_hash")
+
+    storage = get_storage()
+    if file_hash:
+        duplicate = storage.find_by_hash(file_hash)
+        if duplicate:
+            return jsonify({
+                "status": "duplicate",
+                "message": "Duplicate file detected",
+                "uploaded_by": duplicate["uploaded_by"]
+            })
+        return jsonify({"status": "new"})
 
-    # Check for duplicate
-    duplicate = check_duplicate(file_hash)
-    if duplicate:
-        return jsonify({
-            "message": "Duplicate file detected",
-            "uploaded_by": duplicate["uploaded_by"]
-        }), 409
+    try:
+        file_size = int(file_size)
+    except (TypeError, ValueError):
+        file_size = None
+    if file_size is None or not sample_hash:
+        return jsonify({"error": "file_hash or file_size and sample_hash are required"}), 400
 
-    # Save file details to DB
-    add_file_to_db(file.filename, file_path, file_hash, user_id)
-    return jsonify({"message": "File uploaded successfully"})
+    if storage.has_fingerprint(file_size, sample_hash):
+        return jsonify({"status": "candidate", "message": "Send the full file hash to confirm"})
+    return jsonify({"status": "new"})
 
 @app.route("/download_by_name", methods=["POST"])
 def download_by_name():
@@ -121,32 +219,87 @@ def download_by_name():
     if not file_name or not user_id:
         return jsonify({"error": "File name and user ID are required"}), 400
 
-    # Retrieve file details from the database
-    conn = get_db_connection()
-    file_entry = db["files"].find_one({"file_name": file_name})
+    storage = get_storage()
+    with storage.transaction(), metrics.phase("lookup"):
+        # Retrieve file details from the database
+        file_entry = storage.find_by_name(file_name)
 
-    if not file_entry:
-        return jsonify({"error": "File not found"}), 404
+        if not file_entry:
+            return jsonify({"error": "File not found"}), 404
 
-    # Use file hash to detect if the user has already downloaded the file
-    user_download_entry = db["downloads"].find_one({"file_name": file_name, "user_id": user_id})
+        # Detect if the user has already downloaded the file
+        if storage.has_downloaded(file_name, user_id):
+            return jsonify({
+                "message": "Duplicate file detected",
+                "uploaded_by": file_entry.get("uploaded_by") or "Unknown",
+                "users": storage.list_downloaders(file_name)
+            }), 200
 
-    if user_download_entry:
-        return jsonify({
-            "message": "Duplicate file detected",
-            "uploaded_by": file_entry.get("uploaded_by", "Unknown"),
-            "users": list(db["downloads"].find({"file_name": file_name}, {"user_id": 1, "timestamp": 1, "_id": 0}))
-        }), 200
+    # The client fetches the bytes natively from the GET route, which logs
+    # the download and supports resuming
+    return jsonify({
+        "message": "File ready for download",
+        "download_url": url_for("download_file", file_name=file_name, user_id=user_id)
+    }), 200
+
+@app.route("/download/<file_name>", methods=["GET"])
+def download_file(file_name):
+    """
+    Serve a stored file with byte-range support and a strong ETag taken
+    from its content hash. The download is logged for user_id on the first
+    request, not on range requests that resume it.
+    """
+    user_id = request.args.get("user_id")
+    if not user_id:
+        return jsonify({"error": "User ID is required"}), 400
+
+    storage = get_storage()
+    with metrics.phase("lookup"):
+        file_entry = storage.find_by_name(file_name)
+    if not file_entry:
+        return jsonify({"error": "File not found"}), 404
 
-    # Log the download for this user
-    log_download(file_name, user_id)
+    resuming = request.range is not None and request.range.ranges[0][0] != 0
+    if not resuming and not request.if_none_match.contains(file_entry["file_hash"]):
+        with storage.transaction(immediate=True), metrics.phase("write"):
+            if not storage.has_downloaded(file_name, user_id):
+                storage.log_download(file_name, user_id)
 
-    # Return the file as a downloadable response
-    return send_from_directory(
-        directory=os.path.dirname(file_entry["file_path"]),
-        path=os.path.basename(file_entry["file_path"]),
-        as_attachment=True
+    file_path = blobstore.resolve_path(file_entry, BLOB_FOLDER)
+    if SENDFILE_MODE == "x-accel":
+        response = accel_redirect(file_path, file_name, file_entry["file_hash"])
+        if response is not None:
+            return response
+    response = send_file(
+        os.path.abspath(file_path),
+        as_attachment=True,
+        download_name=file_name,
+        etag=file_entry["file_hash"],
+        conditional=True
     )
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
+
+def accel_redirect(file_path, file_name, file_hash):
+    """
+    Let nginx send the file through an internal X-Accel-Redirect location.
+    Returns None for files under neither mapped directory, which the
+    worker then serves itself.
+    """
+    for root, prefix in ((X_ACCEL_ROOT, X_ACCEL_PREFIX), (UPLOAD_FOLDER, X_ACCEL_UPLOADS_PREFIX)):
+        relative_path = os.path.relpath(os.path.abspath(file_path), os.path.abspath(root))
+        if relative_path != os.pardir and not relative_path.startswith(os.pardir + os.sep):
+            break
+    else:
+        return None
+    response = app.response_class(mimetype=mimetypes.guess_type(file_name)[0] or "application/octet-stream")
+    response.set_etag(file_hash)
+    if request.if_none_match.contains(file_hash):
+        response.status_code = 304
+        return response
+    response.headers["X-Accel-Redirect"] = prefix + urllib.parse.quote(relative_path.replace(os.sep, "/"))
+    response.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{urllib.parse.quote(file_name)}"
+    return response
 
 
 @app.route("/download_from_url", methods=["POST"])
@@ -158,82 +311,101 @@ def download_from_url():
     if not file_url or not user_id:
         return jsonify({"error": "Missing file URL or user ID"}), 400
 
-    try:
-        # Handle Google Drive links
-        if "drive.google.com" in file_url:
-            match = re.search(r"/file/d/([^/]+)/", file_url)
-            if match:
-                file_id = match.group(1)
-                file_url = f"https://drive.google.com/uc?export=download&id={file_id}"
-
-        # Fetch file with headers
-        def fetch_file_with_headers(file_url):
-            headers = {
-                "User-Agent": (
-                    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-                    "(KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-                )
-            }
-            request = urllib.request.Request(file_url, headers=headers)
-            response = urllib.request.urlopen(request)
-            return response
-
-        temp_path = os.path.join(app.config["UPLOAD_FOLDER"], "temp_download")
-        with fetch_file_with_headers(file_url) as response, open(temp_path, 'wb') as temp_file:
-            temp_file.write(response.read())
-
-        # Compute file hash
-        file_hash = calculate_file_hash(temp_path)
-
-        # Check for duplicates
-        duplicate = check_duplicate(file_hash=file_hash, url=file_url)
-
-        if duplicate:
-            os.remove(temp_path)  # Clean up temporary file if duplicate detected
-            return jsonify({
-                "message": "Duplicate file detected",
-                "existing_file": duplicate["file_name"],
-                "location": duplicate["file_path"],
-                "metadata": duplicate["metadata"],
-                "users": duplicate["users"]  # Return user info
-            }), 200
-
-        # No duplicate: move the temp file to its final location
-        unique_filename = generate_unique_filename(file_url, file_hash)
-        file_path = os.path.join(app.config["UPLOAD_FOLDER"], unique_filename)
-        os.rename(temp_path, file_path)
-
-        # Add the file to the database
-        add_file_to_db(
-            unique_filename, file_path, file_hash,
-            description=f"Downloaded from {file_url}", url=file_url, user_id=user_id
-        )
-
-        # Log the current user's download
-        log_download(unique_filename, user_id)
-
-        return jsonify({"message": "File downloaded and processed successfully"}), 200
-
-    except urllib.error.HTTPError as e:
-        return jsonify({"error": f"HTTP error occurred: {e.code} {e.reason}"}), e.code
-    except urllib.error.URLError as e:
-        return jsonify({"error": f"URL error occurred: {e.reason}"}), 400
-    except Exception as e:
-        return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
+    # The fetch runs on the background ingest pool; clients poll the job
+    job_id = ingest.submit(file_url, user_id, BLOB_FOLDER)
+    return jsonify({
+        "message": "Download queued",
+        "job_id": job_id,
+        "status_url": f"/jobs/{job_id}"
+    }), 202
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = get_storage().get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
 
 @app.route("/get_files", methods=["GET"])
 def get_files():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT file_name, file_path, uploaded_by FROM files")
-    files = cursor.fetchall()
-    conn.close()
-
-    files_list = [{"file_name": file["file_name"], "file_path": file["file_path"], "uploaded_by": file["uploaded_by"]} for file in files]
-    return jsonify({"files": files_list})
+    """
+    List files one page at a time. Query parameters: limit, cursor (from
+    next_cursor), uploaded_by, type, since and until (ISO 8601, UTC unless
+    an offset is given), prefix and q (name search).
+    Pages are cached per catalog version, which also serves as the ETag.
+    """
+    storage = get_storage()
+    args = request.args
+    filters = {
+        "cursor": args.get("cursor"),
+        "uploaded_by": args.get("uploaded_by"),
+        "file_type": args.get("type"),
+        "since": args.get("since"),
+        "until": args.get("until"),
+        "prefix": args.get("prefix"),
+        "search": args.get("q"),
+    }
+    try:
+        filters["limit"] = int(args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    for bound in ("since", "until"):
+        if filters[bound]:
+            try:
+                filters[bound] = normalize_timestamp(filters[bound])
+            except ValueError:
+                return jsonify({"error": f"{bound} must be an ISO 8601 date or datetime"}), 400
+
+    cache_key = (storage.catalog_version(), tuple(sorted(filters.items())))
+    etag = hashlib.sha256(repr(cache_key).encode("utf-8")).hexdigest()[:32]
+    if request.if_none_match.contains(etag):
+        return "", 304, {"ETag": f'"{etag}"'}
+
+    body = listing_cache.get(cache_key)
+    if body is None:
+        try:
+            with metrics.phase("lookup"):
+                files, next_cursor = storage.list_files(**filters)
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        body = json.dumps({"files": files, "next_cursor": next_cursor})
+        listing_cache.set(cache_key, body)
+    return app.response_class(body, mimetype="application/json", headers={"ETag": f'"{etag}"'})
+
+def cache_samples():
+    """Hit/miss counters of the in-process caches, for /metrics."""
+    stats = {"listing": listing_cache.stats()}
+    storage = get_storage()
+    if isinstance(storage, CachedStorage):
+        stats.update(storage.stats())
+        bloom = stats.pop("bloom")
+        yield ("ddas_bloom_negatives_total", "counter", "Hash lookups the Bloom filter answered alone.",
+               {}, bloom["negatives"])
+        yield ("ddas_bloom_false_positives_total", "counter", "Bloom filter hits with no stored record.",
+               {}, bloom["false_positives"])
+    for cache, counters in stats.items():
+        yield ("ddas_cache_hits_total", "counter", "In-process cache hits.", {"cache": cache}, counters["hits"])
+        yield ("ddas_cache_misses_total", "counter", "In-process cache misses.", {"cache": cache}, counters["misses"])
+        yield ("ddas_cache_entries", "gauge", "Entries held by an in-process cache.", {"cache": cache}, counters["size"])
+
+metrics.register_collector(cache_samples)
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Prometheus text exposition of request, phase, DB, hashing, ingest and cache metrics."""
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    """Hit/miss counters of this worker's in-process caches."""
+    stats = {"listing": listing_cache.stats()}
+    storage = get_storage()
+    if isinstance(storage, CachedStorage):
+        stats.update(storage.stats())
+    return jsonify(stats)
 
 if __name__ == "__main__":
-    if not os.path.exists(UPLOAD_FOLDER):
-        os.makedirs(UPLOAD_FOLDER)
-    init_db()
+    if not os.path.exists(BLOB_FOLDER):
+        os.makedirs(BLOB_FOLDER)
+    get_storage().init()
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,172 @@
+import os
+import tarfile
+import zipfile
+import blobstore
+import similarity
+from streaming import sample_fingerprint, spool_stream
+from storage import DuplicateRecordError, get_storage
+from metrics import phase
+
+
+# Caps on what one uploaded archive may expand to, so a small zip bomb
+# cannot fill the disk: total uncompressed bytes and regular-file members.
+ARCHIVE_MAX_BYTES = int(os.getenv("DDAS_ARCHIVE_MAX_BYTES", str(2 * 1024 ** 3)))
+ARCHIVE_MAX_MEMBERS = int(os.getenv("DDAS_ARCHIVE_MAX_MEMBERS", "10000"))
+
+
+class ArchiveLimitError(Exception):
+    """An archive expands to more members or bytes than allowed."""
+
+
+class _LimitedReader:
+    """Read-only view of an archive member charging every byte to a shared budget."""
+
+    def __init__(self, source, budget):
+        self.source = source
+        self.budget = budget
+
+    def read(self, size=-1):
+        chunk = self.source.read(size)
+        self.budget[0] -= len(chunk)
+        if self.budget[0] < 0:
+            raise ArchiveLimitError(f"Archive expands to more than {self.budget[1]} bytes")
+        return chunk
+
+
+def extract_archive(archive_path, directory, max_bytes=None, max_members=None):
+    """
+    Extract the regular files of a zip or tar archive into hashing spool
+    files, hashing each member as it is decompressed.
+    Raises ArchiveLimitError once the members exceed max_bytes in total or
+    number more than max_members; sizes are counted as bytes are actually
+    decompressed, not taken from the archive headers.
+    Returns a list of (file_name, spool); the caller must discard the spools.
+    """
+    max_members = ARCHIVE_MAX_MEMBERS if max_members is None else max_members
+    max_bytes = ARCHIVE_MAX_BYTES if max_bytes is None else max_bytes
+    # [bytes left, limit], shared by the readers of every member
+    budget = [max_bytes, max_bytes]
+    members = []
+
+    def add(file_name, source):
+        if len(members) >= max_members:
+            raise ArchiveLimitError(f"Archive has more than {max_members} files")
+        members.append((os.path.basename(file_name), spool_stream(_LimitedReader(source, budget), directory)))
+
+    try:
+        if zipfile.is_zipfile(archive_path):
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        continue
+                    with archive.open(info) as source:
+                        add(info.filename, source)
+        else:
+            with tarfile.open(archive_path) as archive:
+                for info in archive:
+                    if not info.isfile():
+                        continue
+                    with archive.extractfile(info) as source:
+                        add(info.name, source)
+    except BaseException:
+        for _, spool in members:
+            spool.discard()
+        raise
+    return members
+
+
+def upload_batch(files, user_id, blob_folder=blobstore.BLOB_FOLDER):
+    """
+    Store many spooled uploads at once. Duplicates are resolved with one
+    set-based lookup per batch and new records are inserted together in a
+    single transaction.
+    Args:
+        files (list): (file_name, HashingSpoolFile) pairs, already hashed.
+        user_id (str): The user ID of the uploader.
+        blob_folder (str): Root of the blob store new content is moved into.
+    Returns:
+        list: One report dict per input file, in input order.
+    """
+    storage = get_storage()
+    files = [(os.path.basename(file_name or ""), spool) for file_name, spool in files]
+    hashes = [spool.hexdigest() for _, spool in files]
+    signatures = [similarity.spool_signature(spool, file_name) if file_name else None for file_name, spool in files]
+
+    reports = []
+    new_records = []
+    with storage.transaction(immediate=True):
+        with phase("lookup"):
+            known_hashes = storage.find_by_hashes(hashes)
+            known_names = storage.find_by_names([file_name for file_name, _ in files])
+        batch_hashes = {}
+        batch_names = set()
+
+        for (file_name, spool), file_hash, signature in zip(files, hashes, signatures):
+            report = {"file_name": file_name, "file_hash": file_hash}
+            reports.append(report)
+
+            duplicate = known_hashes.get(file_hash) or batch_hashes.get(file_hash)
+            if not file_name:
+                report.update(status="rejected", error="Missing file name")
+            elif duplicate:
+                report.update(
+                    status="duplicate", duplicate_of=duplicate["file_name"],
+                    uploaded_by=duplicate["uploaded_by"]
+                )
+            elif file_name in known_names or file_name in batch_names:
+                report.update(status="rejected", error="A different file with this name already exists")
+            else:
+                file_size = spool.size
+                with phase("write"):
+                    file_path = blobstore.put(spool, file_hash, blob_folder)
+                record = {
+                    "file_name": file_name, "file_path": file_path, "file_hash": file_hash,
+                    "uploaded_by": user_id, "file_size": file_size,
+                    "sample_hash": sample_fingerprint(file_path, file_size),
+                    **similarity.signature_fields(signature),
+                }
+                new_records.append((record, report))
+                batch_hashes[file_hash] = record
+                batch_names.add(file_name)
+                report["status"] = "uploaded"
+
+        if new_records:
+            with phase("write"):
+                try:
+                    storage.add_files([record for record, _ in new_records])
+                except DuplicateRecordError:
+                    # Lost a race with a concurrent writer (only possible without
+                    # a real transaction, e.g. on Mongo): settle each record alone.
+                    _settle_records(storage, new_records, blob_folder)
+                for record, report in new_records:
+                    if report["status"] == "uploaded":
+                        similarity.index_signature(
+                            storage, record["file_hash"], record["signature_kind"], record["signature"]
+                        )
+
+    return reports
+
+
+def _settle_records(storage, new_records, blob_folder):
+    stored = storage.find_by_hashes([record["file_hash"] for record, _ in new_records])
+    for record, report in new_records:
+        existing = stored.get(record["file_hash"])
+        if existing and existing["file_name"] == record["file_name"]:
+            continue
+        if not existing:
+            try:
+                storage.add_file(
+                    record["file_name"], record["file_path"], record["file_hash"], record["uploaded_by"],
+                    file_size=record["file_size"], sample_hash=record["sample_hash"],
+                    signature_kind=record["signature_kind"], signature=record["signature"]
+                )
+                continue
+            except DuplicateRecordError:
+                existing = storage.find_by_hash(record["file_hash"])
+        blobstore.release(record["file_hash"], blob_folder)
+        if existing:
+            report.update(
+                status="duplicate", duplicate_of=existing["file_name"], uploaded_by=existing["uploaded_by"]
+            )
+        else:
+            report.update(status="rejected", error="A different file with this name already exists")
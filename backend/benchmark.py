@@ -0,0 +1,452 @@
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# Results of every run are appended here, one JSON object per line.
+RESULTS_PATH = os.getenv("DDAS_BENCH_RESULTS", "bench_results.jsonl")
+SERVER_START_TIMEOUT = 30
+JOB_POLL_INTERVAL = 0.01
+JOB_TIMEOUT = 300
+# Corpus files are written, uploaded and downloaded in chunks of this size,
+# so the harness never holds a whole file and peak RSS reflects the app.
+IO_CHUNK_SIZE = 1024 * 1024
+
+
+def generate_corpus(directory, small_files, small_size, large_files, large_size, duplicate_ratio, seed):
+    """
+    Write a reproducible corpus: many small files and a few large ones,
+    where about duplicate_ratio of them repeat earlier content under a new
+    name. Returns a list of (file_name, path, size).
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    corpus = []
+    # Earlier unique files per size class, as (path, size), for duplicates to copy
+    originals = {"small": [], "large": []}
+    for index, size_class in enumerate(["small"] * small_files + ["large"] * large_files):
+        file_name = f"bench_{index:06d}.bin"
+        path = os.path.join(directory, file_name)
+        if originals[size_class] and rng.random() < duplicate_ratio:
+            original, size = rng.choice(originals[size_class])
+            shutil.copyfile(original, path)
+        else:
+            size = large_size if size_class == "large" else rng.randint(max(small_size // 2, 1), small_size)
+            with open(path, "wb") as f:
+                for offset in range(0, size, IO_CHUNK_SIZE):
+                    f.write(rng.randbytes(min(IO_CHUNK_SIZE, size - offset)))
+            originals[size_class].append((path, size))
+        corpus.append((file_name, path, size))
+    return corpus
+
+
+class TestClientTarget:
+    """Runs requests in-process through Flask's test client."""
+
+    name = "testclient"
+
+    def __init__(self, workdir):
+        os.environ["DDAS_DB_PATH"] = os.path.join(workdir, "files.db")
+        os.environ["DDAS_BLOB_FOLDER"] = os.path.join(workdir, "blobs")
+        # Configuration is read at import, so the app is loaded only now
+        sys.path.insert(0, BACKEND_DIR)
+        import app
+        from storage import get_storage
+        get_storage().init()
+        self.app = app.app
+        self._local = threading.local()
+
+    def _client(self):
+        if not hasattr(self._local, "client"):
+            self._local.client = self.app.test_client()
+        return self._local.client
+
+    def request(self, method, path, json_body=None, file=None, form=None, discard_body=False):
+        """
+        Issue a request; file is (file_name, path) and is streamed from disk.
+        Returns (status, body), or (status, body length) with discard_body.
+        """
+        if file:
+            file_name, file_path = file
+            with open(file_path, "rb") as f:
+                response = self._client().open(path, method=method, data=dict(form or {}, file=(f, file_name)))
+        else:
+            response = self._client().open(path, method=method, json=json_body)
+        if discard_body:
+            length = sum(len(chunk) for chunk in response.iter_encoded())
+            response.close()
+            return response.status_code, length
+        return response.status_code, response.get_data()
+
+    def peak_rss(self):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def close(self):
+        pass
+
+
+class GunicornTarget:
+    """Runs requests over HTTP against gunicorn with several workers."""
+
+    name = "gunicorn"
+
+    def __init__(self, workdir, workers):
+        self.port = _free_port()
+        env = dict(
+            os.environ,
+            DDAS_DB_PATH=os.path.join(workdir, "files.db"),
+            DDAS_BLOB_FOLDER=os.path.join(workdir, "blobs"),
+        )
+        subprocess.run(
+            [sys.executable, "-c", "from storage import get_storage; get_storage().init()"],
+            cwd=BACKEND_DIR, env=env, check=True
+        )
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-w", str(workers), "-b", f"127.0.0.1:{self.port}",
+             "--log-level", "warning", "app:app"],
+            cwd=BACKEND_DIR, env=env
+        )
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                break
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("gunicorn did not start")
+                time.sleep(0.1)
+
+    def request(self, method, path, json_body=None, file=None, form=None, discard_body=False):
+        """
+        Issue a request; file is (file_name, path) and is streamed from disk.
+        Returns (status, body), or (status, body length) with discard_body.
+        """
+        headers = {}
+        body = None
+        if file:
+            body, length, content_type = _multipart(form or {}, file)
+            headers["Content-Type"] = content_type
+            headers["Content-Length"] = str(length)
+        elif json_body is not None:
+            body = json.dumps(json_body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{self.port}{path}", data=body, method=method, headers=headers
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=JOB_TIMEOUT) as response:
+                if discard_body:
+                    chunks = iter(lambda: response.read(IO_CHUNK_SIZE), b"")
+                    return response.status, sum(len(chunk) for chunk in chunks)
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def peak_rss(self):
+        # Exited workers are reaped by the master, which we reap, so the
+        # largest of them shows up in our children's usage
+        return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _multipart(form, file):
+    """Return (chunk iterator, length, content type) of a multipart body streaming the file from disk."""
+    boundary = uuid.uuid4().hex
+    head = b"".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8")
+        for name, value in form.items()
+    )
+    file_name, file_path = file
+    head += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n".encode("utf-8")
+    )
+    tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    def chunks():
+        yield head
+        with open(file_path, "rb") as f:
+            yield from iter(lambda: f.read(IO_CHUNK_SIZE), b"")
+        yield tail
+
+    return chunks(), len(head) + os.path.getsize(file_path) + len(tail), f"multipart/form-data; boundary={boundary}"
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_directory(directory):
+    """Serve directory over HTTP on a local port as a stand-in for remote URLs."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(_QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def run_scenario(operations, concurrency):
+    """
+    Run callables returning (ok, bytes) on a thread pool and summarize
+    throughput and latency.
+    """
+    def timed(operation):
+        started = time.perf_counter()
+        try:
+            ok, size = operation()
+        except Exception:
+            ok, size = False, 0
+        return ok, size, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, operations))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency * 1000 for _, _, latency in results]
+    return {
+        "requests": len(results),
+        "errors": sum(1 for ok, _, _ in results if not ok),
+        "seconds": round(elapsed, 3),
+        "requests_per_sec": round(len(results) / elapsed, 2) if elapsed else None,
+        "mb_per_sec": round(sum(size for _, size, _ in results) / elapsed / 1e6, 2) if elapsed else None,
+        "p50_ms": _round(percentile(latencies, 0.50)),
+        "p95_ms": _round(percentile(latencies, 0.95)),
+        "p99_ms": _round(percentile(latencies, 0.99)),
+    }
+
+
+def _round(value):
+    return round(value, 3) if value is not None else None
+
+
+def upload_operations(target, corpus):
+    def upload(file_name, path, size, user_id):
+        status, _ = target.request("POST", "/upload", file=(file_name, path), form={"user_id": user_id})
+        return status in (200, 409), size
+
+    return [
+        partial(upload, file_name, path, size, f"user{index % 10}")
+        for index, (file_name, path, size) in enumerate(corpus)
+    ]
+
+
+def download_by_name_operations(target, file_names, count, rng):
+    def download(file_name, user_id):
+        status, body = target.request("POST", "/download_by_name", json_body={"file_name": file_name, "user_id": user_id})
+        if status != 200:
+            return False, 0
+        download_url = json.loads(body).get("download_url")
+        if not download_url:
+            return True, 0
+        status, length = target.request("GET", download_url, discard_body=True)
+        return status == 200, length
+
+    return [partial(download, rng.choice(file_names), f"user{rng.randrange(50)}") for _ in range(count)]
+
+
+def stored_file_names(target):
+    """Page through /get_files and return every stored file name."""
+    names = []
+    cursor = None
+    while True:
+        query = {"limit": 1000, **({"cursor": cursor} if cursor else {})}
+        status, body = target.request("GET", "/get_files?" + urllib.parse.urlencode(query))
+        page = json.loads(body)
+        names.extend(file["file_name"] for file in page["files"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            return names
+
+
+def get_files_operations(target, count, rng):
+    def get_files(query):
+        status, _ = target.request("GET", "/get_files?" + urllib.parse.urlencode(query))
+        return status == 200, 0
+
+    queries = [{}, {"limit": 50}, {"q": "bench"}, {"uploaded_by": "user3"}, {"type": "bin", "limit": 500}]
+    return [partial(get_files, rng.choice(queries)) for _ in range(count)]
+
+
+def download_from_url_operations(target, base_url, corpus, count, rng):
+    def download(file_name, user_id):
+        status, body = target.request(
+            "POST", "/download_from_url", json_body={"file_url": f"{base_url}/{file_name}", "user_id": user_id}
+        )
+        if status != 202:
+            return False, 0
+        status_url = json.loads(body)["status_url"]
+        deadline = time.monotonic() + JOB_TIMEOUT
+        while time.monotonic() < deadline:
+            status, body = target.request("GET", status_url)
+            job = json.loads(body)
+            if job["status"] in ("done", "failed"):
+                return job["status"] == "done", job.get("bytes_received") or 0
+            time.sleep(JOB_POLL_INTERVAL)
+        return False, 0
+
+    return [
+        partial(download, file_name, f"user{rng.randrange(50)}")
+        for file_name, _, _ in rng.sample(corpus, min(count, len(corpus)))
+    ]
+
+
+def _tree_size(path):
+    total = 0
+    for directory, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, file_name))
+            except OSError:
+                pass
+    return total
+
+
+def _db_size(workdir):
+    if os.getenv("DDAS_STORAGE", "sqlite") == "mongo":
+        sys.path.insert(0, BACKEND_DIR)
+        from database import get_database
+        return get_database().command("dbstats")["storageSize"]
+    db_path = os.path.join(workdir, "files.db")
+    # Fold the WAL back in first, so the size does not depend on checkpoint timing
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    return sum(os.path.getsize(path) for path in (db_path, db_path + "-wal") if os.path.exists(path))
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the upload, download and listing endpoints.")
+    parser.add_argument("--server", choices=("testclient", "gunicorn"), default="testclient")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn worker processes")
+    parser.add_argument("--concurrency", type=int, default=8, help="Client threads issuing requests")
+    parser.add_argument("--small-files", type=int, default=1000)
+    parser.add_argument("--small-size", type=int, default=16 * 1024, help="Largest small file, in bytes")
+    parser.add_argument("--large-files", type=int, default=2)
+    parser.add_argument("--large-size", type=int, default=64 * 1024 * 1024, help="Size of each large file, in bytes")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.2)
+    parser.add_argument("--requests", type=int, default=500, help="Requests per read scenario")
+    parser.add_argument("--url-downloads", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=RESULTS_PATH, help="JSON lines file the result is appended to")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory (corpus, DB, blobs)")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="ddas_bench_")
+    try:
+        corpus_dir = os.path.join(workdir, "corpus")
+        print(f"Generating corpus in {corpus_dir}", file=sys.stderr)
+        corpus = generate_corpus(
+            corpus_dir, args.small_files, args.small_size, args.large_files, args.large_size,
+            args.duplicate_ratio, args.seed
+        )
+
+        if args.server == "gunicorn":
+            target = GunicornTarget(workdir, args.workers)
+        else:
+            target = TestClientTarget(workdir)
+        file_server = serve_directory(corpus_dir)
+        base_url = f"http://127.0.0.1:{file_server.server_address[1]}"
+
+        scenarios = {}
+        try:
+            scenarios["upload"] = run_scenario(upload_operations(target, corpus), args.concurrency)
+            # Duplicate uploads are not stored under their own name
+            file_names = stored_file_names(target)
+            scenarios["get_files"] = run_scenario(get_files_operations(target, args.requests, rng), args.concurrency)
+            scenarios["download_by_name"] = run_scenario(
+                download_by_name_operations(target, file_names, args.requests, rng), args.concurrency
+            )
+            scenarios["download_from_url"] = run_scenario(
+                download_from_url_operations(target, base_url, corpus, args.url_downloads, rng), args.concurrency
+            )
+        finally:
+            file_server.shutdown()
+            target.close()
+
+        result = {
+            "timestamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "git_commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "server": target.name,
+            "workers": args.workers if args.server == "gunicorn" else 1,
+            "concurrency": args.concurrency,
+            "storage": os.getenv("DDAS_STORAGE", "sqlite"),
+            "corpus": {
+                "files": len(corpus),
+                "bytes": sum(size for _, _, size in corpus),
+                "small_files": args.small_files,
+                "large_files": args.large_files,
+                "duplicate_ratio": args.duplicate_ratio,
+                "seed": args.seed,
+            },
+            "scenarios": scenarios,
+            "peak_rss_bytes": target.peak_rss(),
+            "db_bytes": _db_size(workdir),
+            "blob_bytes": _tree_size(os.path.join(workdir, "blobs")),
+        }
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+        for name, stats in scenarios.items():
+            print(f"{name:18} {stats['requests']:6} req {stats['errors']:4} err {stats['requests_per_sec']:9} req/s "
+                  f"{stats['mb_per_sec']:8} MB/s  p50 {stats['p50_ms']} ms  p95 {stats['p95_ms']} ms  "
+                  f"p99 {stats['p99_ms']} ms")
+        print(f"peak RSS {result['peak_rss_bytes'] / 1e6:.1f} MB, DB {result['db_bytes'] / 1e6:.1f} MB, "
+              f"blobs {result['blob_bytes'] / 1e6:.1f} MB -> {args.output}")
+        return 0
+    finally:
+        if args.keep:
+            print(f"Kept work directory {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
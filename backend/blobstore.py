@@ -0,0 +1,48 @@
+import os
+from storage import get_storage
+
+# Root of the content-addressed store. Blobs live at <root>/ab/cd/<sha256>,
+# so no directory grows beyond 256 entries per level.
+BLOB_FOLDER = os.getenv("DDAS_BLOB_FOLDER", "./static/blobs")
+
+
+def blob_path(file_hash, root=BLOB_FOLDER):
+    """Return where the blob with this SHA-256 is stored."""
+    return os.path.join(root, file_hash[:2], file_hash[2:4], file_hash)
+
+
+def put(spool, file_hash, root=BLOB_FOLDER):
+    """
+    Take a reference on the blob for file_hash and make sure its bytes are
+    stored, moving the spool into place or discarding it if the blob
+    already exists. Returns the blob path.
+    """
+    path = blob_path(file_hash, root)
+    get_storage().acquire_blob(file_hash, spool.size)
+    if os.path.exists(path):
+        spool.discard()
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        spool.commit(path)
+    return path
+
+
+def release(file_hash, root=BLOB_FOLDER):
+    """Drop a reference on the blob, deleting its bytes when none remain."""
+    if get_storage().release_blob(file_hash) == 0:
+        try:
+            os.remove(blob_path(file_hash, root))
+        except FileNotFoundError:
+            pass
+
+
+def resolve_path(record, root=BLOB_FOLDER):
+    """
+    Return the on-disk path for a file record: its blob when one exists,
+    otherwise the path stored before blobs were introduced.
+    """
+    if record.get("file_hash"):
+        path = blob_path(record["file_hash"], root)
+        if os.path.exists(path):
+            return path
+    return record["file_path"]
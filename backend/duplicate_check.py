@@ -1,17 +1,28 @@
 import hashlib
 import os
+import time
 from datetime import datetime
-from database import get_database
+from storage import DuplicateRecordError, get_storage
 import urllib.parse
 import re
+import blobstore
+import similarity
+from streaming import CHUNK_SIZE, sample_fingerprint
+from metrics import record_hashing
 
 
 def calculate_file_hash(file_path):
     """Generate a unique hash (SHA-256) for a file."""
     sha256_hash = hashlib.sha256()
+    hash_seconds = 0.0
+    hashed_bytes = 0
     with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
+        for byte_block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            started = time.perf_counter()
             sha256_hash.update(byte_block)
+            hash_seconds += time.perf_counter() - started
+            hashed_bytes += len(byte_block)
+    record_hashing(hashed_bytes, hash_seconds)
     return sha256_hash.hexdigest()
 
 
@@ -24,51 +35,31 @@ def check_duplicate(file_hash=None, url=None):
     Returns:
         dict: Details of the duplicate file or None if no duplicate is found.
     """
-    db = get_database()
-    collection = db["files"]
+    storage = get_storage()
 
-    # Check by file hash (used for uploads and downloads by name)
+    # Check by file hash (used for uploads and downloads by name), then by
+    # file URL (used for downloads from URL)
+    duplicate_entry = None
     if file_hash:
-        duplicate_entry = collection.find_one({"file_hash": file_hash})
-        if duplicate_entry:
-            # Fetch all users who downloaded the file
-            downloads = db["downloads"].find({"file_hash": file_hash})
-            users = [
-                {"user_id": log.get("user_id"), "timestamp": log.get("timestamp").isoformat()}
-                for log in downloads
-            ]
-            return {
-                "file_name": duplicate_entry["file_name"],
-                "file_path": duplicate_entry["file_path"],
-                "metadata": duplicate_entry.get("metadata"),
-                "source_url": duplicate_entry.get("url"),
-                "uploaded_by": duplicate_entry.get("uploaded_by", "Unknown"),
-                "users": users  # Include users who downloaded the file
-            }
-
-    # Check by file URL (used for downloads from URL)
-    if url:
-        duplicate_entry = collection.find_one({"url": url})
-        if duplicate_entry:
-            # Fetch all users who downloaded the file
-            downloads = db["downloads"].find({"file_name": duplicate_entry["file_name"]})
-            users = [
-                {"user_id": log.get("user_id"), "timestamp": log.get("timestamp").isoformat()}
-                for log in downloads
-            ]
-            return {
-                "file_name": duplicate_entry["file_name"],
-                "file_path": duplicate_entry["file_path"],
-                "metadata": duplicate_entry.get("metadata"),
-                "source_url": duplicate_entry["url"],
-                "uploaded_by": duplicate_entry.get("uploaded_by", "Unknown"),
-                "users": users  # Add users who downloaded the file
-            }
-    return None
-
-
-
-def add_file_to_db(file_name, file_path, file_hash, description=None, url=None, user_id=None):
+        duplicate_entry = storage.find_by_hash(file_hash)
+    if not duplicate_entry and url:
+        duplicate_entry = storage.find_by_url(url)
+    if not duplicate_entry:
+        return None
+
+    return {
+        "file_name": duplicate_entry["file_name"],
+        "file_path": duplicate_entry["file_path"],
+        "metadata": duplicate_entry.get("description"),
+        "source_url": duplicate_entry.get("url"),
+        "uploaded_by": duplicate_entry.get("uploaded_by") or "Unknown",
+        "users": storage.list_downloaders(duplicate_entry["file_name"])  # Users who downloaded the file
+    }
+
+
+def add_file_to_db(file_name, file_path, file_hash, description=None, url=None, user_id=None,
+                   file_size=None, sample_hash=None, etag=None, last_modified=None, content_length=None,
+                   signature_kind=None, signature=None):
     """
     Adds a file record to the database.
     Args:
@@ -78,29 +69,27 @@ def add_file_to_db(file_name, file_path, file_hash, description=None, url=None,
         description (str): A description or additional metadata for the file.
         url (str): The source URL of the file (if applicable).
         user_id (str): The user ID of the uploader (if applicable).
+        file_size (int): The size of the file in bytes.
+        sample_hash (str): The sampled pre-flight fingerprint of the file.
+        etag (str): The ETag returned by the source URL.
+        last_modified (str): The Last-Modified header returned by the source URL.
+        content_length (int): The Content-Length returned by the source URL.
+        signature_kind (str): "image:<method>" or "text" if a near-duplicate signature was computed.
+        signature (str): The perceptual hash or MinHash signature of the file.
     """
-    db = get_database()
-    file_record = {
-        "file_name": file_name,
-        "file_path": file_path,
-        "file_hash": file_hash,
-        "description": description,
-        "url": url,
-        "uploaded_by": user_id  # Add the uploader's user ID here
-    }
-    db["files"].insert_one(file_record)
+    get_storage().add_file(
+        file_name, file_path, file_hash, user_id, url=url, description=description,
+        file_size=file_size, sample_hash=sample_hash,
+        etag=etag, last_modified=last_modified, content_length=content_length,
+        signature_kind=signature_kind, signature=signature
+    )
 
 
 def log_download(file_name, user_id):
     """
     Log the download request with user details.
     """
-    db = get_database()
-    db["downloads"].insert_one({
-        "file_name": file_name,
-        "user_id": user_id,
-        "timestamp": datetime.utcnow(),
-    })
+    get_storage().log_download(file_name, user_id)
 
 
 def sanitize_filename(filename):
@@ -123,5 +112,37 @@ def generate_unique_filename(file_url, file_hash):
     base_name = os.path.basename(parsed_url.path) or "downloaded_file"
     sanitized_name = sanitize_filename(base_name)
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    unique_name = f"{sanitized_name}_{file_hash[:8]}_{timestamp}"
+    # Keep the extension last so the stored file type stays meaningful
+    stem, extension = os.path.splitext(sanitized_name)
+    unique_name = f"{stem}_{file_hash[:8]}_{timestamp}{extension}"
     return unique_name
+
+
+def store_new_file(spool, file_name, file_hash, blob_folder, signature=None, **fields):
+    """
+    Move a hashed spool into the blob store and record it, indexing its
+    near-duplicate signature.
+    Args:
+        spool (HashingSpoolFile): The received content.
+        file_name (str): The name to store the file under.
+        file_hash (str): The SHA-256 of the content.
+        blob_folder (str): Root of the blob store.
+        signature (tuple): (kind, signature) from similarity.spool_signature, or None.
+        **fields: Further add_file_to_db arguments (user_id, url, description, validators).
+    Returns:
+        bool: True if stored, False if a concurrent writer stored the same
+        content or name first; the blob reference is then released.
+    """
+    file_size = spool.size
+    file_path = blobstore.put(spool, file_hash, blob_folder)
+    signature_fields = similarity.signature_fields(signature)
+    try:
+        add_file_to_db(
+            file_name, file_path, file_hash, file_size=file_size,
+            sample_hash=sample_fingerprint(file_path, file_size), **signature_fields, **fields
+        )
+        similarity.index_signature(get_storage(), file_hash, **signature_fields)
+    except DuplicateRecordError:
+        blobstore.release(file_hash, blob_folder)
+        return False
+    return True
@@ -0,0 +1,165 @@
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import blobstore
+import similarity
+from streaming import CHUNK_SIZE, HashingSpoolFile
+from storage import get_storage
+from duplicate_check import check_duplicate, log_download, generate_unique_filename, store_new_file
+from url_cache import normalize_url, conditional_headers, response_validators
+from metrics import INGEST_JOBS, phase, track
+
+# Upper bound on remote fetches running at once in one worker process.
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("DDAS_INGEST_WORKERS", "4"))
+# How often a running job publishes its byte count, in seconds.
+PROGRESS_INTERVAL = 1.0
+FETCH_TIMEOUT = 60
+
+FETCH_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+    )
+}
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=MAX_CONCURRENT_DOWNLOADS, thread_name_prefix="ingest"
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def fetch_file_with_headers(file_url, extra_headers=None):
+    request = urllib.request.Request(file_url, headers={**FETCH_HEADERS, **(extra_headers or {})})
+    return urllib.request.urlopen(request, timeout=FETCH_TIMEOUT)
+
+
+def submit(file_url, user_id, blob_folder=blobstore.BLOB_FOLDER):
+    """
+    Queue a URL download and return its job ID immediately.
+    The job runs on the bounded ingest pool; poll it with get_storage().get_job().
+    """
+    job_id = uuid.uuid4().hex
+    get_storage().create_job(job_id, file_url, user_id)
+    INGEST_JOBS.inc(state="queued")
+    _get_executor().submit(_run_job, job_id, file_url, user_id, blob_folder)
+    return job_id
+
+
+def _run_job(job_id, file_url, user_id, blob_folder):
+    INGEST_JOBS.dec(state="queued")
+    INGEST_JOBS.inc(state="running")
+    try:
+        with track("ingest"):
+            _execute_job(job_id, file_url, user_id, blob_folder)
+    finally:
+        INGEST_JOBS.dec(state="running")
+
+
+def _execute_job(job_id, file_url, user_id, blob_folder):
+    storage = get_storage()
+    storage.update_job(job_id, status="running")
+    try:
+        result = ingest_url(file_url, user_id, blob_folder, job_id=job_id)
+    except urllib.error.HTTPError as e:
+        storage.update_job(job_id, status="failed", error=f"HTTP error occurred: {e.code} {e.reason}")
+    except urllib.error.URLError as e:
+        storage.update_job(job_id, status="failed", error=f"URL error occurred: {e.reason}")
+    except Exception as e:
+        storage.update_job(job_id, status="failed", error=f"An unexpected error occurred: {str(e)}")
+    else:
+        storage.update_job(job_id, status="done", result=result)
+
+
+def ingest_url(file_url, user_id, blob_folder=blobstore.BLOB_FOLDER, job_id=None):
+    """
+    Stream a remote file into a private temp file while hashing it, then
+    either discard it as a duplicate or move it into the blob store.
+    A URL fetched before is revalidated with a conditional GET first, so an
+    unchanged source is reported as a duplicate without downloading it,
+    whichever upload or URL first stored that content.
+    Returns the response body the client sees for the finished job.
+    """
+    storage = get_storage()
+    file_url = normalize_url(file_url)
+    cached = storage.find_cached_url(file_url)
+
+    # Every job spools to its own mkstemp file, so concurrent ingests never collide
+    spool = HashingSpoolFile(blob_folder)
+    try:
+        with phase("fetch"):
+            try:
+                response = fetch_file_with_headers(file_url, conditional_headers(cached) if cached else None)
+            except urllib.error.HTTPError as e:
+                if e.code == 304 and cached:
+                    return _duplicate_response(check_duplicate(file_hash=cached["file_hash"]), revalidated=True)
+                raise
+
+            validators = response_validators(response)
+            with response:
+                last_report = time.monotonic()
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                    spool.write(chunk)
+                    if job_id and time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                        storage.update_job(job_id, bytes_received=spool.size)
+                        last_report = time.monotonic()
+            spool.flush()
+        file_hash = spool.hexdigest()
+        if job_id:
+            storage.update_job(job_id, bytes_received=spool.size)
+        unique_filename = generate_unique_filename(file_url, file_hash)
+        signature = similarity.spool_signature(spool, unique_filename)
+
+        with storage.transaction(immediate=True):
+            # Check for duplicates. The URL alone no longer decides: a source
+            # that changed since the last fetch is stored as new content.
+            with phase("lookup"):
+                duplicate = check_duplicate(file_hash=file_hash)
+            if duplicate:
+                storage.cache_url(file_url, file_hash, **validators)
+                return _duplicate_response(duplicate)
+
+            # No duplicate: move the temp file into the blob store
+            with phase("write"):
+                stored = store_new_file(
+                    spool, unique_filename, file_hash, blob_folder, signature,
+                    description=f"Downloaded from {file_url}", url=file_url, user_id=user_id, **validators
+                )
+                storage.cache_url(file_url, file_hash, **validators)
+                if not stored:
+                    # A concurrent ingest stored the same content first
+                    return _duplicate_response(check_duplicate(file_hash=file_hash))
+
+                # Log the current user's download
+                log_download(unique_filename, user_id)
+
+        return {"message": "File downloaded and processed successfully"}
+    finally:
+        spool.discard()
+
+
+def _duplicate_response(duplicate, revalidated=False):
+    response = {
+        "message": "Duplicate file detected",
+        "existing_file": duplicate["file_name"],
+        "location": duplicate["file_path"],
+        "metadata": duplicate["metadata"],
+        "users": duplicate["users"]  # Return user info
+    }
+    if revalidated:
+        # The source answered 304 Not Modified; nothing was downloaded
+        response["revalidated"] = True
+    return response
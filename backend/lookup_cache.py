@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from cache import BloomFilter, LRUCache
+
+# The hot-path cache sits in front of the metadata backend unless disabled.
+LOOKUP_CACHE_ENABLED = os.getenv("DDAS_LOOKUP_CACHE", "1") == "1"
+# Most file records and downloader lists kept per process, and for how long.
+LOOKUP_CACHE_SIZE = int(os.getenv("DDAS_LOOKUP_CACHE_SIZE", "10000"))
+LOOKUP_CACHE_TTL = float(os.getenv("DDAS_LOOKUP_CACHE_TTL", "300"))
+# False-positive rate of the known-hash Bloom filter; it is rebuilt at
+# twice the catalog size whenever it fills up.
+BLOOM_ERROR_RATE = float(os.getenv("DDAS_BLOOM_ERROR_RATE", "0.001"))
+BLOOM_MIN_CAPACITY = 100000
+# How often (seconds) catalog_version is re-read to catch up with other
+# workers' inserts. In between, a hash another worker just stored can be
+# reported as new; the unique index still rejects the insert that follows.
+CATALOG_POLL_INTERVAL = float(os.getenv("DDAS_CATALOG_POLL_INTERVAL", "0.25"))
+
+
+class CachedStorage:
+    """
+    Read-through cache in front of a metadata backend for the duplicate
+    lookup hot path. Every other method is passed straight through.
+
+    - find_by_hash/find_by_hashes answer from an LRU of file records, and
+      a Bloom filter over all stored hashes answers "definitely new"
+      without touching the files table.
+    - list_downloaders answers from a per-file cache of downloader lists.
+    - has_downloaded remembers every (file, user) pair it has seen
+      downloaded, for good since downloads are append-only; other pairs
+      go to the indexed query.
+
+    Workers stay consistent through counters in the database: whenever
+    catalog_version moves, the Bloom filter loads the hashes added since
+    its last catch-up (storage.list_hashes cursor), and downloader lists
+    are dropped whenever downloads_version moves. catalog_version is read
+    at most every CATALOG_POLL_INTERVAL, so "definitely new" answers
+    usually cost no query at all.
+    File records are never deleted or changed, so cached records stay
+    valid; the TTL only bounds how long cold entries are kept.
+    """
+
+    def __init__(self, storage, maxsize=LOOKUP_CACHE_SIZE, ttl=LOOKUP_CACHE_TTL):
+        self.storage = storage
+        self.records = LRUCache(maxsize, ttl)
+        self.downloaders = LRUCache(maxsize, ttl)
+        self.downloaded = LRUCache(maxsize)
+        self.bloom = None
+        self.bloom_negatives = 0
+        self.bloom_false_positives = 0
+        self._bloom_version = None
+        self._bloom_checked = float("-inf")
+        self._hash_cursor = None
+        self._downloads_version = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def _known_hashes(self):
+        """Return the Bloom filter, first catching up with other writers."""
+        now = time.monotonic()
+        if self.bloom is not None and now - self._bloom_checked < CATALOG_POLL_INTERVAL:
+            return self.bloom
+        version = self.storage.catalog_version()
+        self._bloom_checked = now
+        with self._lock:
+            if self.bloom is not None and version <= self._bloom_version:
+                # The filter only grows, so it covers every older snapshot
+                return self.bloom
+            hashes, self._hash_cursor = self.storage.list_hashes(
+                since=self._hash_cursor if self.bloom is not None else None
+            )
+            self._add_hashes(hashes)
+            self._bloom_version = version
+            return self.bloom
+
+    def _add_hashes(self, hashes):
+        # Called with self._lock held
+        if self.bloom is None or self.bloom.count + len(hashes) > self.bloom.capacity:
+            hashes = hashes if self.bloom is None else self.storage.list_hashes()[0] + list(hashes)
+            self.bloom = BloomFilter(max(BLOOM_MIN_CAPACITY, 2 * len(hashes)), BLOOM_ERROR_RATE)
+        for file_hash in hashes:
+            self.bloom.add(file_hash)
+
+    def find_by_hash(self, file_hash):
+        """Return the file record with this content hash, or None."""
+        record = self.records.get(file_hash)
+        if record is None:
+            if file_hash not in self._known_hashes():
+                self.bloom_negatives += 1
+                return None
+            record = self.storage.find_by_hash(file_hash)
+            if record is None:
+                self.bloom_false_positives += 1
+                return None
+            self.records.set(file_hash, record)
+        return dict(record)
+
+    def find_by_hashes(self, file_hashes):
+        """Return {file_hash: record} for every stored hash in file_hashes."""
+        found = {}
+        missing = []
+        for file_hash in dict.fromkeys(file_hashes):
+            record = self.records.get(file_hash)
+            if record is None:
+                missing.append(file_hash)
+            else:
+                found[file_hash] = dict(record)
+        if missing:
+            known = self._known_hashes()
+            candidates = [file_hash for file_hash in missing if file_hash in known]
+            self.bloom_negatives += len(missing) - len(candidates)
+            if candidates:
+                records = self.storage.find_by_hashes(candidates)
+                self.bloom_false_positives += len(candidates) - len(records)
+                for file_hash, record in records.items():
+                    self.records.set(file_hash, record)
+                    found[file_hash] = dict(record)
+        return found
+
+    def add_file(self, file_name, file_path, file_hash, uploaded_by, **fields):
+        """Insert file metadata into the database."""
+        self.storage.add_file(file_name, file_path, file_hash, uploaded_by, **fields)
+        self._remember_hashes([file_hash])
+
+    def add_files(self, records):
+        """Insert many file records (dicts keyed by FILE_COLUMNS) in one transaction."""
+        self.storage.add_files(records)
+        self._remember_hashes([record["file_hash"] for record in records])
+
+    def _remember_hashes(self, hashes):
+        # Our own inserts are visible at once; other workers' arrive through list_hashes
+        with self._lock:
+            if self.bloom is not None:
+                self._add_hashes([file_hash for file_hash in hashes if file_hash])
+
+    def list_downloaders(self, file_name):
+        """Return the user ID and timestamp of every download of the file."""
+        version = self.storage.downloads_version()
+        if version != self._downloads_version:
+            self.downloaders.clear()
+            self._downloads_version = version
+        downloaders = self.downloaders.get(file_name)
+        if downloaders is None:
+            downloaders = self.storage.list_downloaders(file_name)
+            self.downloaders.set(file_name, downloaders)
+        return list(downloaders)
+
+    def has_downloaded(self, file_name, user_id):
+        """Check if the user has already downloaded the file."""
+        if self.downloaded.get((file_name, user_id)):
+            return True
+        if not self.storage.has_downloaded(file_name, user_id):
+            return False
+        self.downloaded.set((file_name, user_id), True)
+        return True
+
+    def log_download(self, file_name, user_id):
+        """Log user downloads."""
+        self.storage.log_download(file_name, user_id)
+        self.downloaders.pop(file_name)
+        self.downloaded.set((file_name, user_id), True)
+
+    def stats(self):
+        """Hit/miss counters of the lookup caches."""
+        bloom = self.bloom
+        return {
+            "records": self.records.stats(),
+            "downloaders": self.downloaders.stats(),
+            "downloaded": self.downloaded.stats(),
+            "bloom": {
+                "hashes": bloom.count if bloom else 0,
+                "capacity": bloom.capacity if bloom else 0,
+                "negatives": self.bloom_negatives,
+                "false_positives": self.bloom_false_positives,
+            },
+        }
@@ -0,0 +1,397 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from contextlib import contextmanager
+
+# Request instrumentation is on unless disabled; it costs a few
+# perf_counter() calls and lock round-trips per request.
+METRICS_ENABLED = os.getenv("DDAS_METRICS", "1") == "1"
+# With several worker processes, each one snapshots its metrics into this
+# directory every SNAPSHOT_INTERVAL seconds from a background thread, busy
+# or idle, and /metrics serves the sum, whichever worker answers.
+METRICS_DIR = os.getenv("DDAS_METRICS_DIR")
+SNAPSHOT_INTERVAL = float(os.getenv("DDAS_METRICS_SNAPSHOT_INTERVAL", "1"))
+# Adds a Server-Timing header with the phase timings to every response.
+SERVER_TIMING_ENABLED = os.getenv("DDAS_SERVER_TIMING", "0") == "1"
+# Lets a request ask for a sampling profile with "X-DDAS-Profile: 1" or ?profile=1.
+PROFILING_ENABLED = os.getenv("DDAS_PROFILING", "0") == "1"
+PROFILE_DIR = os.getenv("DDAS_PROFILE_DIR", "./profiles")
+PROFILE_INTERVAL = float(os.getenv("DDAS_PROFILE_INTERVAL", "0.001"))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Metric:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "type": self.type, "help": self.help, "labelnames": list(self.labelnames),
+                "values": [[list(key), value] for key, value in self._values.items()],
+            }
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """Values are [count per bucket..., sum, count], buckets not cumulative."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 3)
+            values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot["values"] = [[key, list(values)] for key, values in snapshot["values"]]
+        snapshot["buckets"] = list(self.buckets)
+        return snapshot
+
+
+_registry = {}
+# Functions returning (name, type, help, labels, value) samples at scrape time
+_collectors = []
+
+REQUEST_DURATION = Histogram(
+    "ddas_request_duration_seconds", "Time to handle a request.", ("route", "method", "status")
+)
+REQUESTS_IN_FLIGHT = Gauge("ddas_requests_in_flight", "Requests being handled.", ("route",))
+PHASE_DURATION = Histogram(
+    "ddas_phase_duration_seconds",
+    "Time per request spent receiving the body, hashing, looking up duplicates, writing or fetching.",
+    ("route", "phase")
+)
+DB_QUERY_DURATION = Histogram(
+    "ddas_db_query_duration_seconds", "Metadata backend calls by route and operation.", ("route", "operation")
+)
+HASHED_BYTES = Counter("ddas_hashed_bytes_total", "Bytes run through SHA-256.")
+HASH_SECONDS = Counter("ddas_hash_seconds_total", "Time spent in SHA-256; bytes/sec is the ratio of the rates.")
+INGEST_JOBS = Gauge("ddas_ingest_jobs", "URL ingest jobs by state.", ("state",))
+
+_local = threading.local()
+
+
+def register_collector(collector):
+    """Add a function returning (name, type, help, labels, value) samples for each scrape."""
+    _collectors.append(collector)
+
+
+def start_request(route):
+    """Start timing a request (or background job) on this thread."""
+    if METRICS_DIR and _snapshot_pid != os.getpid():
+        _start_snapshot_thread()
+    _local.route = route
+    _local.started = time.perf_counter()
+    _local.phases = {}
+    _local.db_calls = 0
+    _local.db_seconds = 0.0
+    REQUESTS_IN_FLIGHT.inc(route=route)
+
+
+def finish_request(method, status):
+    """
+    Record the request's duration and phases. Returns
+    [(name, seconds, description)] for a Server-Timing header.
+    """
+    route = getattr(_local, "route", None)
+    if route is None:
+        return []
+    elapsed = time.perf_counter() - _local.started
+    REQUESTS_IN_FLIGHT.dec(route=route)
+    REQUEST_DURATION.observe(elapsed, route=route, method=method, status=status)
+    for phase, seconds in _local.phases.items():
+        PHASE_DURATION.observe(seconds, route=route, phase=phase)
+    timings = [(phase, seconds, None) for phase, seconds in _local.phases.items()]
+    if _local.db_calls:
+        timings.append(("db", _local.db_seconds, f"{_local.db_calls} calls"))
+    timings.append(("total", elapsed, None))
+    _local.route = None
+    return timings
+
+
+@contextmanager
+def track(route):
+    """Instrument a unit of work outside a request, e.g. an ingest job."""
+    start_request(route)
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        finish_request("job", status)
+
+
+def _add_phase(phase, seconds):
+    if getattr(_local, "route", None) is not None:
+        _local.phases[phase] = _local.phases.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def phase(name):
+    """Add the time spent in the block to the current request's phase."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_phase(name, time.perf_counter() - started)
+
+
+def record_hashing(nbytes, seconds):
+    """Count bytes hashed, charging the time to the current request's hash phase."""
+    HASHED_BYTES.inc(nbytes)
+    HASH_SECONDS.inc(seconds)
+    _add_phase("hash", seconds)
+
+
+def server_timing(timings):
+    """Format finish_request() timings as a Server-Timing header value."""
+    entries = []
+    for name, seconds, description in timings:
+        entry = f"{name};dur={seconds * 1000:.2f}"
+        if description:
+            entry += f';desc="{description}"'
+        entries.append(entry)
+    return ", ".join(entries)
+
+
+class InstrumentedStorage:
+    """Times every call into a metadata backend, by route and operation."""
+
+    # Returns a context manager; the statements inside are timed instead
+    UNTIMED = {"transaction"}
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        attribute = getattr(self.storage, name)
+        if not callable(attribute) or name in self.UNTIMED or name.startswith("_"):
+            return attribute
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                route = getattr(_local, "route", None)
+                DB_QUERY_DURATION.observe(elapsed, route=route or "none", operation=name)
+                if route is not None:
+                    _local.db_calls += 1
+                    _local.db_seconds += elapsed
+        return timed
+
+
+class SamplingProfiler:
+    """
+    Samples one thread's Python stack every interval from a helper thread
+    and counts identical stacks, in the collapsed format flame graph tools
+    (flamegraph.pl, speedscope) read.
+    """
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = _Tally()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="ddas-profiler")
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def write(self, label):
+        """Write the collapsed stacks under PROFILE_DIR and return the path."""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = re.sub(r"[^\w.-]+", "_", label).strip("_") or "request"
+        path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d%H%M%S')}_{os.getpid()}_{name}.folded")
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+def snapshot():
+    """This process's metrics, including collector samples, as plain data."""
+    metrics = {name: metric.snapshot() for name, metric in list(_registry.items())}
+    for collector in _collectors:
+        for name, metric_type, help, labels, value in collector():
+            metric = metrics.setdefault(
+                name, {"type": metric_type, "help": help, "labelnames": sorted(labels), "values": []}
+            )
+            metric["values"].append([[str(labels[label]) for label in metric["labelnames"]], value])
+    return metrics
+
+
+_snapshot_pid = None
+_snapshot_lock = threading.Lock()
+
+
+def _start_snapshot_thread():
+    # Once per process: a thread started before a fork does not survive it
+    global _snapshot_pid
+    with _snapshot_lock:
+        if _snapshot_pid != os.getpid():
+            _snapshot_pid = os.getpid()
+            threading.Thread(target=_snapshot_loop, daemon=True, name="ddas-metrics-snapshot").start()
+
+
+def _snapshot_loop():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        try:
+            write_snapshot()
+        except OSError as e:
+            print(f"Could not write metrics snapshot: {e}", file=sys.stderr)
+
+
+def write_snapshot():
+    """Publish this process's metrics for the other workers to merge."""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(merged, metrics, include_gauges):
+    for name, metric in metrics.items():
+        if metric["type"] == "gauge" and not include_gauges:
+            continue
+        target = merged.setdefault(name, dict(metric, values={}))
+        for key, value in metric["values"]:
+            key = tuple(key)
+            if key not in target["values"]:
+                target["values"][key] = list(value) if isinstance(value, list) else value
+            elif isinstance(value, list):
+                target["values"][key] = [a + b for a, b in zip(target["values"][key], value)]
+            else:
+                target["values"][key] += value
+
+
+def collect():
+    """Metrics of this process, summed with the other workers' snapshots when METRICS_DIR is set."""
+    merged = {}
+    _merge(merged, snapshot(), include_gauges=True)
+    if METRICS_DIR:
+        write_snapshot()
+        for file_name in os.listdir(METRICS_DIR):
+            pid, extension = os.path.splitext(file_name)
+            if extension != ".json" or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, file_name)) as f:
+                    metrics = json.load(f)
+            except (OSError, ValueError):
+                continue
+            # Counters of exited workers still count; their gauges do not
+            _merge(merged, metrics, include_gauges=_pid_alive(int(pid)))
+    return merged
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{label}="{_escape(value)}"' for label, value in pairs) + "}"
+
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    lines = []
+    for name, metric in sorted(collect().items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        labelnames = metric["labelnames"]
+        for key, value in sorted(metric["values"].items()):
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_labels(labelnames, key)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric["buckets"]) + ["+Inf"], value[:-2]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labelnames, key, [('le', str(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labelnames, key)} {value[-2]}")
+            lines.append(f"{name}_count{_labels(labelnames, key)} {value[-1]}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,412 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import blobstore
+from batch import upload_batch
+from duplicate_check import calculate_file_hash
+from storage import MAX_PAGE_SIZE, get_storage
+from streaming import spool_stream
+
+# Where file hashes are remembered between runs, keyed by (path, size, mtime).
+SCAN_CACHE_PATH = os.getenv("DDAS_SCAN_CACHE", ".ddas_scan_cache.db")
+SCAN_WORKERS = int(os.getenv("DDAS_SCAN_WORKERS", str(os.cpu_count() or 1)))
+# Files handed to a hashing process at a time; amortizes IPC for small files.
+HASH_CHUNKSIZE = 16
+# New files stored per catalog transaction when importing.
+IMPORT_BATCH_SIZE = 200
+# How often progress is printed, in seconds.
+PROGRESS_INTERVAL = 1.0
+
+
+class HashCache:
+    """
+    SQLite-backed map of (path, size, mtime) to SHA-256, so rescans only
+    hash files that were added or changed since the last run.
+    """
+
+    def __init__(self, path=SCAN_CACHE_PATH):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS scan_cache (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            file_hash TEXT
+        )
+        """)
+
+    def get(self, path, size, mtime_ns):
+        row = self.conn.execute(
+            "SELECT file_hash FROM scan_cache WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, size, mtime_ns)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put_many(self, entries):
+        """Store (path, size, mtime_ns, file_hash) tuples."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO scan_cache (path, size, mtime_ns, file_hash) VALUES (?, ?, ?, ?)",
+                entries
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+class Progress:
+    """Counts scanned and hashed files and prints throughput to stderr."""
+
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.started = time.monotonic()
+        self.files = 0
+        self.bytes = 0
+        self.hashed_files = 0
+        self.hashed_bytes = 0
+        self.cached = 0
+        self.errors = 0
+        self._last_report = 0
+
+    def hashed(self, size):
+        self.hashed_files += 1
+        self.hashed_bytes += size
+        self.report()
+
+    def report(self, final=False):
+        now = time.monotonic()
+        if self.quiet or (not final and now - self._last_report < PROGRESS_INTERVAL):
+            return
+        self._last_report = now
+        print(f"\r{self.summary()}", end="\n" if final else "", file=sys.stderr, flush=True)
+
+    def rates(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return elapsed, self.hashed_files / elapsed, self.hashed_bytes / elapsed / 1e6
+
+    def summary(self):
+        elapsed, files_per_sec, mb_per_sec = self.rates()
+        return (
+            f"{self.files} files ({self.bytes / 1e6:.1f} MB) scanned, {self.hashed_files} hashed, "
+            f"{self.cached} cached, {self.errors} unreadable in {elapsed:.1f}s: "
+            f"{files_per_sec:.1f} files/s, {mb_per_sec:.1f} MB/s"
+        )
+
+
+def walk(roots, skip=()):
+    """
+    Yield (path, size, mtime_ns) for every regular file under roots.
+    Symlinks, upload spool files and the skip directories are left out.
+    """
+    skip = {os.path.abspath(path) for path in skip}
+    stack = [os.path.abspath(root) for root in roots]
+    while stack:
+        directory = stack.pop()
+        if directory in skip:
+            continue
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False) and not entry.name.startswith(".incoming_"):
+                stat = entry.stat(follow_symlinks=False)
+                yield entry.path, stat.st_size, stat.st_mtime_ns
+
+
+def _hash_file(path):
+    try:
+        return path, calculate_file_hash(path)
+    except OSError:
+        return path, None
+
+
+def hash_files(entries, cache, progress, workers=SCAN_WORKERS):
+    """
+    Return {path: file_hash} for (path, size, mtime_ns) entries. Only files
+    missing from the cache are read, spread over a pool of processes.
+    """
+    hashes = {}
+    pending = {}
+    for path, size, mtime_ns in entries:
+        progress.files += 1
+        progress.bytes += size
+        file_hash = cache.get(path, size, mtime_ns)
+        if file_hash:
+            hashes[path] = file_hash
+            progress.cached += 1
+        else:
+            pending[path] = (size, mtime_ns)
+    if not pending:
+        return hashes
+
+    fresh = []
+    if workers > 1 and len(pending) > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(_hash_file, pending, chunksize=HASH_CHUNKSIZE)
+    else:
+        executor = None
+        results = map(_hash_file, pending)
+    try:
+        for path, file_hash in results:
+            size, mtime_ns = pending[path]
+            if file_hash is None:
+                progress.errors += 1
+                continue
+            hashes[path] = file_hash
+            fresh.append((path, size, mtime_ns, file_hash))
+            progress.hashed(size)
+    finally:
+        if executor:
+            executor.shutdown()
+        cache.put_many(fresh)
+    return hashes
+
+
+def duplicate_groups(hashes, sizes):
+    """Return the groups of scanned paths with identical content, largest waste first."""
+    by_hash = {}
+    for path, file_hash in hashes.items():
+        by_hash.setdefault(file_hash, []).append(path)
+    groups = [
+        {"file_hash": file_hash, "size": sizes[paths[0]], "paths": sorted(paths)}
+        for file_hash, paths in by_hash.items() if len(paths) > 1
+    ]
+    groups.sort(key=lambda group: group["size"] * (len(group["paths"]) - 1), reverse=True)
+    return groups
+
+
+def import_files(hashes, catalog, user_id, blob_folder=blobstore.BLOB_FOLDER):
+    """
+    Store one copy of every scanned file whose content is not catalogued
+    yet, in batches. Files that changed since they were hashed are skipped.
+    Returns the per-file reports of batch.upload_batch.
+    """
+    first_paths = {}
+    for path, file_hash in sorted(hashes.items()):
+        if file_hash not in catalog:
+            first_paths.setdefault(file_hash, path)
+
+    reports = []
+    paths = list(first_paths.items())
+    names = _import_names(paths)
+    for start in range(0, len(paths), IMPORT_BATCH_SIZE):
+        files = []
+        try:
+            for file_hash, path in paths[start:start + IMPORT_BATCH_SIZE]:
+                try:
+                    with open(path, "rb") as source:
+                        spool = spool_stream(source, blob_folder)
+                except OSError as e:
+                    reports.append({"file_name": os.path.basename(path), "status": "rejected", "error": str(e)})
+                    continue
+                if spool.hexdigest() != file_hash:
+                    spool.discard()
+                    reports.append({
+                        "file_name": os.path.basename(path), "status": "rejected",
+                        "error": "File changed during the scan"
+                    })
+                    continue
+                files.append((names[file_hash], spool))
+            reports.extend(upload_batch(files, user_id, blob_folder))
+        finally:
+            for _, spool in files:
+                spool.discard()
+    return reports
+
+
+def _import_names(paths):
+    """
+    Catalog name for each (file_hash, path) being imported: the base name,
+    or "<stem>_<hash prefix><ext>" when another imported file or a stored
+    record already uses it, since catalog names are unique.
+    """
+    counts = {}
+    for _, path in paths:
+        base_name = os.path.basename(path)
+        counts[base_name] = counts.get(base_name, 0) + 1
+    taken = get_storage().find_by_names(counts)
+    names = {}
+    for file_hash, path in paths:
+        base_name = os.path.basename(path)
+        if counts[base_name] > 1 or base_name in taken:
+            stem, extension = os.path.splitext(base_name)
+            base_name = f"{stem}_{file_hash[:8]}{extension}"
+        names[file_hash] = base_name
+    return names
+
+
+def iter_catalog(storage):
+    """Yield every file record in the catalog, one page at a time."""
+    cursor = None
+    while True:
+        page, cursor = storage.list_files(limit=MAX_PAGE_SIZE, cursor=cursor)
+        records = storage.find_by_names([file["file_name"] for file in page])
+        for file in page:
+            if file["file_name"] in records:
+                yield records[file["file_name"]]
+        if not cursor:
+            return
+
+
+def reconcile(storage, cache, progress, scanned_hashes, fix=False, workers=SCAN_WORKERS,
+              blob_folder=blobstore.BLOB_FOLDER):
+    """
+    Check that every catalog record's content exists and still has its
+    hash. With fix, content that is missing or altered is restored into the
+    blob store from a scanned copy with the right hash.
+    Returns (missing, mismatched, restored) lists of file names.
+    """
+    records = {}
+    entries = []
+    missing = []
+    for record in iter_catalog(storage):
+        path = os.path.abspath(blobstore.resolve_path(record, blob_folder))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            missing.append(record)
+            continue
+        records[path] = record
+        entries.append((path, stat.st_size, stat.st_mtime_ns))
+
+    hashes = hash_files(entries, cache, progress, workers)
+    mismatched = [
+        record for path, record in records.items()
+        if path in hashes and hashes[path] != record["file_hash"]
+    ]
+
+    restored = []
+    if fix:
+        sources = {}
+        for path, file_hash in scanned_hashes.items():
+            sources.setdefault(file_hash, path)
+        for record in missing + mismatched:
+            source = sources.get(record["file_hash"])
+            if source and _restore_blob(storage, record, source, blob_folder):
+                restored.append(record["file_name"])
+
+    return (
+        [record["file_name"] for record in missing],
+        [record["file_name"] for record in mismatched],
+        restored,
+    )
+
+
+def _restore_blob(storage, record, source, blob_folder):
+    try:
+        with open(source, "rb") as f:
+            spool = spool_stream(f, blob_folder)
+    except OSError:
+        return False
+    if spool.hexdigest() != record["file_hash"]:
+        spool.discard()
+        return False
+    path = blobstore.blob_path(record["file_hash"], blob_folder)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    spool.commit(path)
+    if os.path.abspath(record["file_path"]) != os.path.abspath(path):
+        # Records from before the blob store never held a blob reference
+        storage.acquire_blob(record["file_hash"], spool.size)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Find duplicate files in directory trees and import or reconcile them with the catalog."
+    )
+    parser.add_argument("roots", nargs="+", help="Directories to scan")
+    parser.add_argument("--import", dest="import_files", action="store_true",
+                        help="Add files whose content is not in the catalog yet")
+    parser.add_argument("--user", default="scanner", help="Uploader recorded for imported files")
+    parser.add_argument("--reconcile", action="store_true",
+                        help="Report catalog records whose content is missing or altered")
+    parser.add_argument("--fix", action="store_true",
+                        help="With --reconcile, restore such content from scanned copies")
+    parser.add_argument("--workers", type=int, default=SCAN_WORKERS, help="Hashing processes")
+    parser.add_argument("--cache", default=SCAN_CACHE_PATH, help="Hash cache database")
+    parser.add_argument("--blob-folder", default=blobstore.BLOB_FOLDER, help="Root of the blob store")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--quiet", action="store_true", help="Do not print progress")
+    args = parser.parse_args(argv)
+
+    cache = HashCache(args.cache)
+    progress = Progress(quiet=args.quiet)
+    try:
+        # The blob store is managed content, never a source to scan
+        entries = list(walk(args.roots, skip=[args.blob_folder]))
+        sizes = {path: size for path, size, _ in entries}
+        hashes = hash_files(entries, cache, progress, args.workers)
+        progress.report(final=True)
+
+        storage = get_storage()
+        storage.init()
+        catalog = storage.find_by_hashes(set(hashes.values()))
+        groups = duplicate_groups(hashes, sizes)
+        report = {
+            "files": len(entries),
+            "bytes": sum(sizes.values()),
+            "hashed_files": progress.hashed_files,
+            "cached_files": progress.cached,
+            "unreadable_files": progress.errors,
+            "duplicate_groups": groups,
+            "reclaimable_bytes": sum(group["size"] * (len(group["paths"]) - 1) for group in groups),
+            "catalogued": sorted(path for path, file_hash in hashes.items() if file_hash in catalog),
+        }
+        report["seconds"], report["files_per_sec"], report["mb_per_sec"] = progress.rates()
+
+        if args.import_files:
+            report["imported"] = import_files(hashes, catalog, args.user, args.blob_folder)
+        if args.reconcile:
+            missing, mismatched, restored = reconcile(
+                storage, cache, progress, hashes, fix=args.fix, workers=args.workers,
+                blob_folder=args.blob_folder
+            )
+            report.update(missing=missing, mismatched=mismatched, restored=restored)
+    finally:
+        cache.close()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+
+def print_report(report):
+    print(f"Scanned {report['files']} files ({report['bytes'] / 1e6:.1f} MB) in {report['seconds']:.1f}s: "
+          f"{report['files_per_sec']:.1f} files/s, {report['mb_per_sec']:.1f} MB/s hashed "
+          f"({report['cached_files']} from cache, {report['unreadable_files']} unreadable)")
+    print(f"{len(report['duplicate_groups'])} duplicate groups, "
+          f"{report['reclaimable_bytes'] / 1e6:.1f} MB reclaimable")
+    for group in report["duplicate_groups"]:
+        print(f"  {group['file_hash'][:12]}  {group['size']} bytes x {len(group['paths'])}")
+        for path in group["paths"]:
+            print(f"    {path}")
+    print(f"{len(report['catalogued'])} files already in the catalog")
+    if "imported" in report:
+        counts = {}
+        for item in report["imported"]:
+            counts[item["status"]] = counts.get(item["status"], 0) + 1
+        print("Import: " + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+        for item in report["imported"]:
+            if item["status"] == "rejected":
+                print(f"  rejected {item['file_name']}: {item['error']}")
+    if "missing" in report:
+        print(f"Reconcile: {len(report['missing'])} missing, {len(report['mismatched'])} altered, "
+              f"{len(report['restored'])} restored")
+        for file_name in report["missing"]:
+            print(f"  missing {file_name}")
+        for file_name in report["mismatched"]:
+            print(f"  altered {file_name}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,231 @@
+import hashlib
+import math
+import os
+import random
+import re
+from metrics import phase
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; images are then only exact-matched
+    Image = None
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # pypdf is optional; PDFs are then only exact-matched
+    PdfReader = None
+
+# Near-duplicate detection is off unless enabled, since it costs extra work per upload.
+NEAR_DUPLICATES_ENABLED = os.getenv("DDAS_NEAR_DUPLICATES", "0") == "1"
+# Minimum similarity (0-1) at which an upload is reported as a near-duplicate.
+SIMILARITY_THRESHOLD = float(os.getenv("DDAS_SIMILARITY_THRESHOLD", "0.9"))
+# Perceptual hash used for images: "ahash", "dhash" or "phash".
+IMAGE_HASH_METHOD = os.getenv("DDAS_IMAGE_HASH", "phash")
+
+IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "bmp", "webp"}
+TEXT_EXTENSIONS = {"txt"}
+PDF_EXTENSIONS = {"pdf"}
+
+# Image hashes are 64 bits split into IMAGE_BANDS exact-match segments. Two
+# hashes within IMAGE_BANDS - 1 differing bits always share a segment, so
+# one band more than the distance the threshold allows means lookups never
+# miss a match (7 bands, i.e. 9-10 bit segments, at the default 0.9).
+# storage.init() rebuilds the stored image keys when this count changes.
+IMAGE_BITS = 64
+IMAGE_BANDS = min(IMAGE_BITS, max(1, math.floor(IMAGE_BITS * (1 - SIMILARITY_THRESHOLD)) + 1))
+
+# Text is compared by MinHash over word shingles, indexed with LSH: pairs
+# agreeing on all rows of any band become candidates.
+SHINGLE_SIZE = 5
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+LSH_ROWS = MINHASH_PERMUTATIONS // LSH_BANDS
+# Only the start of very large documents is shingled.
+MAX_TEXT_CHARS = 200000
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(1)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
+
+
+def _extension(file_name):
+    return os.path.splitext(file_name)[1].lstrip(".").lower()
+
+
+def _grayscale(file_path, width, height):
+    with Image.open(file_path) as image:
+        return list(image.convert("L").resize((width, height), Image.LANCZOS).getdata())
+
+
+def _bits_to_hex(bits):
+    return f"{int(''.join('1' if bit else '0' for bit in bits), 2):016x}"
+
+
+def average_hash(file_path):
+    """aHash: 8x8 grayscale thumbnail, one bit per pixel above the mean."""
+    pixels = _grayscale(file_path, 8, 8)
+    mean = sum(pixels) / len(pixels)
+    return _bits_to_hex(pixel > mean for pixel in pixels)
+
+
+def difference_hash(file_path):
+    """dHash: 9x8 grayscale thumbnail, one bit per horizontal gradient."""
+    pixels = _grayscale(file_path, 9, 8)
+    return _bits_to_hex(
+        pixels[row * 9 + col] > pixels[row * 9 + col + 1] for row in range(8) for col in range(8)
+    )
+
+
+_DCT_SIZE = 32
+_DCT_COS = [
+    [math.cos((2 * x + 1) * u * math.pi / (2 * _DCT_SIZE)) for x in range(_DCT_SIZE)]
+    for u in range(8)
+]
+
+
+def perceptual_hash(file_path):
+    """pHash: low 8x8 frequencies of a 32x32 DCT, one bit per coefficient above the median."""
+    pixels = _grayscale(file_path, _DCT_SIZE, _DCT_SIZE)
+    rows = [pixels[y * _DCT_SIZE:(y + 1) * _DCT_SIZE] for y in range(_DCT_SIZE)]
+    # Separable 2D DCT, computing only the 8x8 block that is kept
+    partial = [[sum(c * p for c, p in zip(_DCT_COS[v], row)) for v in range(8)] for row in rows]
+    coefficients = [
+        sum(_DCT_COS[u][y] * partial[y][v] for y in range(_DCT_SIZE))
+        for u in range(8) for v in range(8)
+    ]
+    # The DC term only reflects overall brightness, so it is left out of the median
+    median = sorted(coefficients[1:])[len(coefficients[1:]) // 2]
+    return _bits_to_hex(coefficient > median for coefficient in coefficients)
+
+
+IMAGE_HASHES = {
+    "ahash": average_hash,
+    "dhash": difference_hash,
+    "phash": perceptual_hash,
+}
+if IMAGE_HASH_METHOD not in IMAGE_HASHES:
+    raise ValueError(f"Unknown image hash: {IMAGE_HASH_METHOD}")
+# Hashes of different methods are not comparable, so the method is part of the kind
+IMAGE_KIND = f"image:{IMAGE_HASH_METHOD}"
+
+
+def _read_text(file_path, extension):
+    if extension in PDF_EXTENSIONS:
+        reader = PdfReader(file_path)
+        text = []
+        size = 0
+        for page in reader.pages:
+            text.append(page.extract_text() or "")
+            size += len(text[-1])
+            if size >= MAX_TEXT_CHARS:
+                break
+        return "\n".join(text)[:MAX_TEXT_CHARS]
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+        return f.read(MAX_TEXT_CHARS)
+
+
+def minhash(text):
+    """MinHash signature over word shingles, as fixed-width hex."""
+    words = re.findall(r"\w+", text.lower())
+    shingles = {
+        " ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))
+    }
+    hashes = [
+        int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for shingle in shingles
+    ]
+    signature = [
+        min((a * value + b) % _MERSENNE_PRIME for value in hashes) & 0xFFFFFFFF
+        for a, b in _PERMUTATIONS
+    ]
+    return "".join(f"{value:08x}" for value in signature)
+
+
+def compute_signature(file_path, file_name):
+    """
+    Return (kind, signature) for files that support near-duplicate
+    detection, or None. kind is "image:<method>" or "text".
+    """
+    extension = _extension(file_name)
+    try:
+        if extension in IMAGE_EXTENSIONS and Image is not None:
+            return IMAGE_KIND, IMAGE_HASHES[IMAGE_HASH_METHOD](file_path)
+        if extension in TEXT_EXTENSIONS or (extension in PDF_EXTENSIONS and PdfReader is not None):
+            text = _read_text(file_path, extension)
+            if text.strip():
+                return "text", minhash(text)
+    except Exception:
+        # Unreadable or corrupt content is simply not similarity-indexed
+        return None
+    return None
+
+
+def similarity(kind, signature, other):
+    """Similarity in [0, 1] between two signatures of the same kind."""
+    if kind.startswith("image:"):
+        distance = bin(int(signature, 16) ^ int(other, 16)).count("1")
+        return 1 - distance / IMAGE_BITS
+    values = [signature[i:i + 8] for i in range(0, len(signature), 8)]
+    other_values = [other[i:i + 8] for i in range(0, len(other), 8)]
+    return sum(a == b for a, b in zip(values, other_values)) / len(values)
+
+
+def index_keys(kind, signature):
+    """Bucket keys under which a signature is indexed and looked up."""
+    if kind.startswith("image:"):
+        bits = f"{int(signature, 16):0{IMAGE_BITS}b}"
+        bounds = [band * IMAGE_BITS // IMAGE_BANDS for band in range(IMAGE_BANDS + 1)]
+        # The band count is part of the key so a changed threshold never
+        # matches segments cut at other bounds
+        return [
+            f"{band}/{IMAGE_BANDS}:{bits[bounds[band]:bounds[band + 1]]}" for band in range(IMAGE_BANDS)
+        ]
+    width = LSH_ROWS * 8
+    return [f"{band}:{signature[band * width:(band + 1) * width]}" for band in range(LSH_BANDS)]
+
+
+def spool_signature(spool, file_name):
+    """
+    Signature of a spooled incoming file, or None when near-duplicate
+    detection is off. Callers compute it before taking the write lock,
+    since it can be slow.
+    """
+    if not NEAR_DUPLICATES_ENABLED:
+        return None
+    spool.flush()
+    with phase("signature"):
+        return compute_signature(spool.name, file_name)
+
+
+def signature_fields(signature):
+    """The signature_kind and signature columns of a file record."""
+    return {
+        "signature_kind": signature[0] if signature else None,
+        "signature": signature[1] if signature else None,
+    }
+
+
+def index_signature(storage, file_hash, signature_kind=None, signature=None):
+    """Index a stored file's signature, if it has one, under its bucket keys."""
+    if signature:
+        storage.add_similarity_keys(file_hash, signature_kind, index_keys(signature_kind, signature))
+
+
+def find_near_duplicate(storage, kind, signature, threshold=None):
+    """
+    Return (record, score) for the most similar stored file at or above
+    threshold, or None. Only files sharing an index bucket are compared.
+    """
+    threshold = SIMILARITY_THRESHOLD if threshold is None else threshold
+    candidates = storage.find_similarity_candidates(kind, index_keys(kind, signature))
+    best = None
+    for record in storage.find_by_hashes(candidates).values():
+        if record.get("signature_kind") != kind or not record.get("signature"):
+            continue
+        score = similarity(kind, signature, record["signature"])
+        if score >= threshold and (best is None or score > best[1]):
+            best = (record, score)
+    return best
@@ -0,0 +1,919 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import urllib.parse
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from lookup_cache import LOOKUP_CACHE_ENABLED, CachedStorage
+from metrics import METRICS_ENABLED, InstrumentedStorage
+import similarity
+from streaming import sample_fingerprint
+
+# Which metadata backend get_storage() returns: "sqlite" or "mongo"
+STORAGE_BACKEND = os.getenv("DDAS_STORAGE", "sqlite")
+DB_PATH = os.getenv("DDAS_DB_PATH", "files.db")
+
+# Applied to every pooled connection. WAL lets readers run alongside the
+# single writer, and NORMAL sync is durable in WAL mode except on power loss.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",
+)
+BUSY_TIMEOUT = 10.0
+# How far back a Mongo catch-up of new hashes re-reads, in seconds. Must
+# exceed the longest a bulk insert can take to land, plus clock skew
+# between workers, or a lookup cache can miss a stored hash.
+MONGO_CATCHUP_WINDOW = float(os.getenv("DDAS_MONGO_CATCHUP_WINDOW", "60"))
+# Stay well below SQLite's limit on bound parameters per statement.
+MAX_IN_PARAMS = 500
+# Ingest jobs run on an in-process pool, so a restart orphans them. init()
+# fails queued or running jobs untouched for this long (seconds); running
+# jobs report progress every second, and younger ones may belong to a
+# process that is still alive.
+JOB_STALE_AFTER = float(os.getenv("DDAS_JOB_STALE_AFTER", "600"))
+JOB_ORPHANED_ERROR = "The server restarted before the job finished"
+
+_local = threading.local()
+
+
+class DuplicateRecordError(Exception):
+    """A file record with the same unique hash or name already exists."""
+
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_db_connection():
+    """
+    Return this thread's pooled connection, opening it on first use.
+    Connections are never shared across threads or forked workers.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = _connect()
+        _local.conn = conn
+        _local.pid = os.getpid()
+        _local.depth = 0
+    return conn
+
+
+@contextmanager
+def transaction(immediate=False):
+    """
+    Run the enclosed statements in one transaction on the pooled connection.
+    Nested blocks join the outermost transaction. Use immediate=True when the
+    block writes after reading so the write lock is taken up front.
+    """
+    conn = get_db_connection()
+    if _local.depth:
+        _local.depth += 1
+        try:
+            yield conn
+        finally:
+            _local.depth -= 1
+        return
+
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    _local.depth = 1
+    try:
+        yield conn
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+    finally:
+        _local.depth = 0
+
+
+FILE_COLUMNS = ("file_name", "file_path", "file_hash", "uploaded_by", "url", "description",
+                "file_size", "sample_hash", "etag", "last_modified", "content_length",
+                "signature_kind", "signature", "file_type", "uploaded_at")
+# Most rows returned by one /get_files page
+MAX_PAGE_SIZE = 1000
+JOB_FIELDS = ("status", "bytes_received", "result", "error")
+URL_CACHE_FIELDS = ("file_hash", "etag", "last_modified", "content_length")
+
+
+def _file_record(file_name, file_path, file_hash, uploaded_by, **fields):
+    """Build a full file record, deriving the listing columns from the name."""
+    record = dict(fields, file_name=file_name, file_path=file_path, file_hash=file_hash, uploaded_by=uploaded_by)
+    record.setdefault("file_type", _file_type(file_name))
+    record.setdefault("uploaded_at", datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
+    return record
+
+
+def _file_type(file_name):
+    """Lower-case extension of a file name, or None."""
+    return os.path.splitext(file_name or "")[1].lstrip(".").lower() or None
+
+
+def normalize_timestamp(value):
+    """
+    Parse an ISO 8601 date or datetime into the "YYYY-MM-DD HH:MM:SS" UTC
+    form uploaded_at is stored in; raises ValueError on anything else.
+    """
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _fts_query(search):
+    """Turn free text into an FTS5 query matching every word as a prefix."""
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", search))
+
+
+class SQLiteStorage:
+    """Metadata backend on the pooled per-thread SQLite connections."""
+
+    def transaction(self, immediate=False):
+        return transaction(immediate)
+
+    def init(self):
+        """Create tables and indexes, migrating older databases in place."""
+        with transaction(immediate=True) as conn:
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_name TEXT UNIQUE,
+                file_path TEXT,
+                file_hash TEXT UNIQUE,
+                uploaded_by TEXT,
+                url TEXT,
+                description TEXT,
+                file_size INTEGER,
+                sample_hash TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                content_length INTEGER,
+                signature_kind TEXT,
+                signature TEXT,
+                file_type TEXT,
+                uploaded_at TEXT,
+                catalog_seq INTEGER
+            )
+            """)
+
+            # Databases created by older versions lack the newer columns
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(files)")}
+            for column, column_type in (
+                ("description", "TEXT"), ("file_size", "INTEGER"), ("sample_hash", "TEXT"),
+                ("etag", "TEXT"), ("last_modified", "TEXT"), ("content_length", "INTEGER"),
+                ("signature_kind", "TEXT"), ("signature", "TEXT"),
+                ("file_type", "TEXT"), ("uploaded_at", "TEXT"), ("catalog_seq", "INTEGER")
+            ):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE files ADD COLUMN {column} {column_type}")
+
+            # Full-text index over file names, kept in sync by triggers
+            has_fts = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'files_fts'"
+            ).fetchone()
+            if not has_fts:
+                conn.execute(
+                    "CREATE VIRTUAL TABLE files_fts USING fts5(file_name, content='files', content_rowid='id')"
+                )
+                conn.execute("INSERT INTO files_fts(files_fts) VALUES ('rebuild')")
+            conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+                INSERT INTO files_fts(rowid, file_name) VALUES (new.id, new.file_name);
+            END
+            """)
+            conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+                INSERT INTO files_fts(files_fts, rowid, file_name) VALUES ('delete', old.id, old.file_name);
+            END
+            """)
+            conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS files_fts_update AFTER UPDATE OF file_name ON files BEGIN
+                INSERT INTO files_fts(files_fts, rowid, file_name) VALUES ('delete', old.id, old.file_name);
+                INSERT INTO files_fts(rowid, file_name) VALUES (new.id, new.file_name);
+            END
+            """)
+
+            # Bumped with every catalog insert or logged download; listings and
+            # lookup caches are kept per version
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+            """)
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('catalog_version', 0)")
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('downloads_version', 0)")
+
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_name TEXT,
+                user_id TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (file_name) REFERENCES files(file_name)
+            )
+            """)
+
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                file_hash TEXT PRIMARY KEY,
+                size INTEGER,
+                ref_count INTEGER NOT NULL DEFAULT 0
+            )
+            """)
+
+            # Validators of the last response per normalized URL, whatever
+            # record holds the content, for conditional re-fetches
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS url_cache (
+                url TEXT PRIMARY KEY,
+                file_hash TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                content_length INTEGER,
+                fetched_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS similarity_keys (
+                kind TEXT,
+                key TEXT,
+                file_hash TEXT
+            )
+            """)
+
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_jobs (
+                id TEXT PRIMARY KEY,
+                file_url TEXT,
+                user_id TEXT,
+                status TEXT,
+                bytes_received INTEGER DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_files_sample ON files(file_size, sample_hash)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_files_url ON files(url)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_downloads_file_user ON downloads(file_name, user_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_similarity_keys ON similarity_keys(kind, key)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_files_uploader ON files(uploaded_by, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_files_type ON files(file_type, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_files_uploaded_at ON files(uploaded_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_files_catalog_seq ON files(catalog_seq)")
+
+            self._backfill_fingerprints(conn)
+            self._backfill_file_types(conn)
+            # URLs fetched before url_cache existed; newest record per URL wins
+            conn.execute("""
+                INSERT OR IGNORE INTO url_cache (url, file_hash, etag, last_modified, content_length)
+                SELECT url, file_hash, etag, last_modified, content_length FROM files
+                WHERE url IS NOT NULL ORDER BY id DESC
+            """)
+            self._reindex_image_signatures(conn)
+            conn.execute(
+                "UPDATE ingest_jobs SET status = 'failed', error = ?, updated_at = CURRENT_TIMESTAMP "
+                "WHERE status IN ('queued', 'running') AND updated_at < datetime('now', ?)",
+                (JOB_ORPHANED_ERROR, f"-{JOB_STALE_AFTER} seconds")
+            )
+
+    def _reindex_image_signatures(self, conn):
+        """Rebuild the image bucket keys when the band count (set by the threshold) changed."""
+        if self._meta_value(conn, "image_bands") == similarity.IMAGE_BANDS:
+            return
+        conn.execute("DELETE FROM similarity_keys WHERE kind LIKE 'image:%'")
+        rows = conn.execute(
+            "SELECT file_hash, signature_kind, signature FROM files "
+            "WHERE signature_kind LIKE 'image:%' AND signature IS NOT NULL"
+        ).fetchall()
+        conn.executemany(
+            "INSERT INTO similarity_keys (kind, key, file_hash) VALUES (?, ?, ?)",
+            [(row["signature_kind"], key, row["file_hash"])
+             for row in rows for key in similarity.index_keys(row["signature_kind"], row["signature"])]
+        )
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('image_bands', ?)", (similarity.IMAGE_BANDS,))
+
+    def _backfill_fingerprints(self, conn):
+        """Fill in size and sample fingerprint for rows stored before they existed."""
+        rows = conn.execute("SELECT id, file_path FROM files WHERE sample_hash IS NULL").fetchall()
+        for row in rows:
+            if not row["file_path"] or not os.path.exists(row["file_path"]):
+                continue
+            file_size = os.path.getsize(row["file_path"])
+            conn.execute(
+                "UPDATE files SET file_size = ?, sample_hash = ? WHERE id = ?",
+                (file_size, sample_fingerprint(row["file_path"], file_size), row["id"])
+            )
+
+    def _backfill_file_types(self, conn):
+        """
+        Derive the file type of rows stored before it was recorded, and of
+        URL downloads whose generated names used to end in "_<hash>_<time>".
+        """
+        rows = conn.execute("""
+            SELECT id, file_name, url FROM files
+            WHERE file_type IS NULL OR (url IS NOT NULL AND instr(file_type, '_') > 0)
+        """).fetchall()
+        conn.executemany(
+            "UPDATE files SET file_type = ? WHERE id = ?",
+            [(_file_type(urllib.parse.urlparse(row["url"]).path if row["url"] else row["file_name"]), row["id"])
+             for row in rows]
+        )
+
+    def _find_file(self, column, value):
+        # Newest first, so a URL resolves to the latest content fetched from it
+        row = get_db_connection().execute(
+            f"SELECT {', '.join(FILE_COLUMNS)} FROM files WHERE {column} = ? ORDER BY id DESC LIMIT 1",
+            (value,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def find_by_hash(self, file_hash):
+        """Return the file record with this content hash, or None."""
+        return self._find_file("file_hash", file_hash)
+
+    def find_by_url(self, url):
+        """Return the file record downloaded from this URL, or None."""
+        return self._find_file("url", url)
+
+    def find_cached_url(self, url):
+        """Return the content hash and validators last fetched from this URL, or None."""
+        row = get_db_connection().execute(
+            "SELECT url, file_hash, etag, last_modified, content_length FROM url_cache WHERE url = ?", (url,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def find_by_name(self, file_name):
+        """Return the file record with this name, or None."""
+        return self._find_file("file_name", file_name)
+
+    def _find_files(self, column, values):
+        values = list(dict.fromkeys(values))
+        records = {}
+        conn = get_db_connection()
+        for start in range(0, len(values), MAX_IN_PARAMS):
+            chunk = values[start:start + MAX_IN_PARAMS]
+            rows = conn.execute(
+                f"SELECT {', '.join(FILE_COLUMNS)} FROM files WHERE {column} IN ({', '.join('?' * len(chunk))})",
+                chunk
+            )
+            records.update((row[column], dict(row)) for row in rows)
+        return records
+
+    def find_by_hashes(self, file_hashes):
+        """Return {file_hash: record} for every stored hash in file_hashes."""
+        return self._find_files("file_hash", file_hashes)
+
+    def find_by_names(self, file_names):
+        """Return {file_name: record} for every stored name in file_names."""
+        return self._find_files("file_name", file_names)
+
+    def has_fingerprint(self, file_size, sample_hash):
+        """Check if any stored file has the same size and sample fingerprint."""
+        candidate = get_db_connection().execute(
+            "SELECT 1 FROM files WHERE file_size = ? AND sample_hash = ? LIMIT 1",
+            (file_size, sample_hash)
+        ).fetchone()
+        return candidate is not None
+
+    def add_file(self, file_name, file_path, file_hash, uploaded_by, url=None, description=None,
+                 file_size=None, sample_hash=None, etag=None, last_modified=None, content_length=None,
+                 signature_kind=None, signature=None):
+        """Insert file metadata into the database."""
+        self.add_files([{
+            "file_name": file_name, "file_path": file_path, "file_hash": file_hash, "uploaded_by": uploaded_by,
+            "url": url, "description": description, "file_size": file_size, "sample_hash": sample_hash,
+            "etag": etag, "last_modified": last_modified, "content_length": content_length,
+            "signature_kind": signature_kind, "signature": signature,
+        }])
+
+    def add_files(self, records):
+        """
+        Insert many file records (dicts keyed by FILE_COLUMNS) in one
+        transaction, stamping them with the catalog version it bumps to.
+        """
+        records = [_file_record(**record) for record in records]
+        try:
+            with transaction() as conn:
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'catalog_version'")
+                seq = self._meta_value(conn, "catalog_version")
+                conn.executemany(f"""
+                    INSERT INTO files ({', '.join(FILE_COLUMNS)}, catalog_seq)
+                    VALUES ({', '.join('?' * len(FILE_COLUMNS))}, ?)""",
+                    [tuple(record.get(column) for column in FILE_COLUMNS) + (seq,) for record in records]
+                )
+        except sqlite3.IntegrityError as e:
+            raise DuplicateRecordError(str(e)) from e
+
+    def _meta_value(self, conn, key):
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else 0
+
+    def catalog_version(self):
+        """Return a counter that changes whenever files are added."""
+        return self._meta_value(get_db_connection(), "catalog_version")
+
+    def downloads_version(self):
+        """Return a counter that changes whenever a download is logged."""
+        return self._meta_value(get_db_connection(), "downloads_version")
+
+    def list_hashes(self, since=None):
+        """
+        Return (hashes, cursor): every stored hash, or only those added
+        after the cursor of an earlier call was taken.
+        """
+        with transaction() as conn:
+            version = self._meta_value(conn, "catalog_version")
+            if since is None:
+                rows = conn.execute("SELECT file_hash FROM files WHERE file_hash IS NOT NULL")
+            else:
+                rows = conn.execute(
+                    "SELECT file_hash FROM files WHERE catalog_seq > ? AND file_hash IS NOT NULL", (since,)
+                )
+            return [row["file_hash"] for row in rows], version
+
+    def add_similarity_keys(self, file_hash, kind, keys):
+        """Index a file's near-duplicate signature under its bucket keys."""
+        with transaction() as conn:
+            conn.executemany(
+                "INSERT INTO similarity_keys (kind, key, file_hash) VALUES (?, ?, ?)",
+                [(kind, key, file_hash) for key in keys]
+            )
+
+    def find_similarity_candidates(self, kind, keys):
+        """Return the hashes of files sharing at least one bucket key."""
+        rows = get_db_connection().execute(
+            f"SELECT DISTINCT file_hash FROM similarity_keys WHERE kind = ? AND key IN ({', '.join('?' * len(keys))})",
+            [kind] + list(keys)
+        )
+        return [row["file_hash"] for row in rows]
+
+    def acquire_blob(self, file_hash, size):
+        """Add a reference to the content-addressed blob for file_hash."""
+        with transaction() as conn:
+            conn.execute("""
+                INSERT INTO blobs (file_hash, size, ref_count) VALUES (?, ?, 1)
+                ON CONFLICT(file_hash) DO UPDATE SET ref_count = ref_count + 1""",
+                (file_hash, size)
+            )
+
+    def release_blob(self, file_hash):
+        """Drop a reference to the blob and return how many remain."""
+        with transaction() as conn:
+            conn.execute("UPDATE blobs SET ref_count = ref_count - 1 WHERE file_hash = ?", (file_hash,))
+            row = conn.execute("SELECT ref_count FROM blobs WHERE file_hash = ?", (file_hash,)).fetchone()
+            if row and row["ref_count"] <= 0:
+                conn.execute("DELETE FROM blobs WHERE file_hash = ?", (file_hash,))
+        return max(row["ref_count"], 0) if row else 0
+
+    def cache_url(self, url, file_hash, etag=None, last_modified=None, content_length=None):
+        """Remember the content and HTTP validators a URL just returned."""
+        with transaction() as conn:
+            conn.execute(
+                """INSERT INTO url_cache (url, file_hash, etag, last_modified, content_length)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET file_hash = excluded.file_hash, etag = excluded.etag,
+                    last_modified = excluded.last_modified, content_length = excluded.content_length,
+                    fetched_at = CURRENT_TIMESTAMP""",
+                (url, file_hash, etag, last_modified, content_length)
+            )
+
+    def log_download(self, file_name, user_id):
+        """Log user downloads."""
+        with transaction() as conn:
+            conn.execute("INSERT INTO downloads (file_name, user_id) VALUES (?, ?)", (file_name, user_id))
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'downloads_version'")
+
+    def has_downloaded(self, file_name, user_id):
+        """Check if the user has already downloaded the file."""
+        row = get_db_connection().execute(
+            "SELECT 1 FROM downloads WHERE file_name = ? AND user_id = ? LIMIT 1", (file_name, user_id)
+        ).fetchone()
+        return row is not None
+
+    def list_files(self, limit=100, cursor=None, uploaded_by=None, file_type=None, since=None, until=None,
+                   prefix=None, search=None):
+        """
+        Return one page of files in insertion order and the cursor for the
+        next page (None on the last page). Filters combine with AND; search
+        matches words of the file name through the FTS5 index.
+        """
+        conditions = []
+        params = []
+        if cursor:
+            conditions.append("f.id > ?")
+            params.append(int(cursor))
+        if uploaded_by:
+            conditions.append("f.uploaded_by = ?")
+            params.append(uploaded_by)
+        if file_type:
+            conditions.append("f.file_type = ?")
+            params.append(file_type.lower())
+        if since:
+            conditions.append("f.uploaded_at >= ?")
+            params.append(normalize_timestamp(since))
+        if until:
+            conditions.append("f.uploaded_at < ?")
+            params.append(normalize_timestamp(until))
+        if prefix:
+            # A range scan on the file_name index instead of LIKE
+            conditions.append("f.file_name >= ? AND f.file_name < ?")
+            params.extend([prefix, prefix + "\U0010ffff"])
+        join = ""
+        if search:
+            query = _fts_query(search)
+            if not query:
+                return [], None
+            join = "JOIN files_fts ON files_fts.rowid = f.id"
+            conditions.append("files_fts MATCH ?")
+            params.append(query)
+
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = get_db_connection().execute(f"""
+            SELECT f.id, f.file_name, f.file_path, f.uploaded_by, f.file_size, f.file_type, f.uploaded_at
+            FROM files f {join} {where}
+            ORDER BY f.id LIMIT ?""",
+            params + [limit + 1]
+        ).fetchall()
+
+        files = [dict(row) for row in rows[:limit]]
+        next_cursor = str(files[-1].pop("id")) if len(rows) > limit else None
+        for file in files:
+            file.pop("id", None)
+        return files, next_cursor
+
+    def list_downloaders(self, file_name):
+        """Return the user ID and timestamp of every download of the file."""
+        rows = get_db_connection().execute(
+            "SELECT user_id, timestamp FROM downloads WHERE file_name = ? ORDER BY id", (file_name,)
+        )
+        return [dict(row) for row in rows]
+
+    def create_job(self, job_id, file_url, user_id):
+        """Record a queued URL ingest job."""
+        with transaction() as conn:
+            conn.execute(
+                "INSERT INTO ingest_jobs (id, file_url, user_id, status) VALUES (?, ?, ?, 'queued')",
+                (job_id, file_url, user_id)
+            )
+
+    def update_job(self, job_id, **fields):
+        """Update status, bytes_received, result or error of an ingest job."""
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"])
+        assignments = ", ".join(f"{field} = ?" for field in fields if field in JOB_FIELDS)
+        with transaction() as conn:
+            conn.execute(
+                f"UPDATE ingest_jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                [fields[field] for field in fields if field in JOB_FIELDS] + [job_id]
+            )
+
+    def get_job(self, job_id):
+        """Return an ingest job as a dict, or None."""
+        row = get_db_connection().execute(
+            "SELECT id, file_url, user_id, status, bytes_received, result, error, created_at, updated_at "
+            "FROM ingest_jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if not row:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+
+class MongoStorage:
+    """
+    Metadata backend on MongoDB. Uses the process-wide pooled client from
+    database.get_database() unless a database (e.g. from mongomock) is given.
+    """
+
+    def __init__(self, database=None):
+        self._database = database
+
+    @property
+    def db(self):
+        if self._database is not None:
+            return self._database
+        from database import get_database
+        return get_database()
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        # Single-document writes are atomic; unique indexes catch races.
+        yield self.db
+
+    def init(self):
+        """Create the indexes the lookups rely on."""
+        files = self.db["files"]
+        files.create_index("file_hash", unique=True, sparse=True)
+        files.create_index("file_name", unique=True, sparse=True)
+        files.create_index("url")
+        files.create_index([("file_size", 1), ("sample_hash", 1)])
+        self.db["downloads"].create_index([("file_name", 1), ("user_id", 1)])
+        self.db["similarity_keys"].create_index([("kind", 1), ("key", 1)])
+        files.create_index("uploaded_by")
+        files.create_index("file_type")
+        files.create_index("uploaded_at")
+        self._reindex_image_signatures()
+        now = datetime.utcnow()
+        self.db["ingest_jobs"].update_many(
+            {"status": {"$in": ["queued", "running"]}, "updated_at": {"$lt": now - timedelta(seconds=JOB_STALE_AFTER)}},
+            {"$set": {"status": "failed", "error": JOB_ORPHANED_ERROR, "updated_at": now}}
+        )
+
+    def _reindex_image_signatures(self):
+        """Rebuild the image bucket keys when the band count (set by the threshold) changed."""
+        if self._meta_value("image_bands") == similarity.IMAGE_BANDS:
+            return
+        self.db["similarity_keys"].delete_many({"kind": {"$regex": "^image:"}})
+        documents = self.db["files"].find(
+            {"signature_kind": {"$regex": "^image:"}, "signature": {"$ne": None}},
+            {"_id": 0, "file_hash": 1, "signature_kind": 1, "signature": 1}
+        )
+        keys = [
+            {"kind": document["signature_kind"], "key": key, "file_hash": document["file_hash"]}
+            for document in documents
+            for key in similarity.index_keys(document["signature_kind"], document["signature"])
+        ]
+        if keys:
+            self.db["similarity_keys"].insert_many(keys)
+        self.db["meta"].update_one({"_id": "image_bands"}, {"$set": {"value": similarity.IMAGE_BANDS}}, upsert=True)
+
+    def _find_file(self, query):
+        # Newest first, so a URL resolves to the latest content fetched from it
+        entry = self.db["files"].find_one(query, {"_id": 0}, sort=[("_id", -1)])
+        if not entry:
+            return None
+        return {column: entry.get(column) for column in FILE_COLUMNS}
+
+    def find_by_hash(self, file_hash):
+        """Return the file record with this content hash, or None."""
+        return self._find_file({"file_hash": file_hash})
+
+    def find_by_url(self, url):
+        """Return the file record downloaded from this URL, or None."""
+        return self._find_file({"url": url})
+
+    def find_cached_url(self, url):
+        """Return the content hash and validators last fetched from this URL, or None."""
+        entry = self.db["url_cache"].find_one({"_id": url})
+        if not entry:
+            return None
+        return {"url": entry["_id"], **{field: entry.get(field) for field in URL_CACHE_FIELDS}}
+
+    def find_by_name(self, file_name):
+        """Return the file record with this name, or None."""
+        return self._find_file({"file_name": file_name})
+
+    def _find_files(self, field, values):
+        entries = self.db["files"].find({field: {"$in": list(set(values))}}, {"_id": 0})
+        return {entry[field]: {column: entry.get(column) for column in FILE_COLUMNS} for entry in entries}
+
+    def find_by_hashes(self, file_hashes):
+        """Return {file_hash: record} for every stored hash in file_hashes."""
+        return self._find_files("file_hash", file_hashes)
+
+    def find_by_names(self, file_names):
+        """Return {file_name: record} for every stored name in file_names."""
+        return self._find_files("file_name", file_names)
+
+    def has_fingerprint(self, file_size, sample_hash):
+        """Check if any stored file has the same size and sample fingerprint."""
+        return self.db["files"].find_one(
+            {"file_size": file_size, "sample_hash": sample_hash}, {"_id": 1}
+        ) is not None
+
+    def add_file(self, file_name, file_path, file_hash, uploaded_by, url=None, description=None,
+                 file_size=None, sample_hash=None, etag=None, last_modified=None, content_length=None,
+                 signature_kind=None, signature=None):
+        """Insert file metadata into the database."""
+        self.add_files([{
+            "file_name": file_name, "file_path": file_path, "file_hash": file_hash, "uploaded_by": uploaded_by,
+            "url": url, "description": description, "file_size": file_size, "sample_hash": sample_hash,
+            "etag": etag, "last_modified": last_modified, "content_length": content_length,
+            "signature_kind": signature_kind, "signature": signature,
+        }])
+
+    def add_files(self, records):
+        """Insert many file records (dicts keyed by FILE_COLUMNS) in one bulk write."""
+        from pymongo.errors import BulkWriteError
+        documents = [
+            {column: record.get(column) for column in FILE_COLUMNS}
+            for record in (_file_record(**record) for record in records)
+        ]
+        try:
+            self.db["files"].insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            raise DuplicateRecordError(str(e)) from e
+        finally:
+            # Only bumped once the rows are visible, so a listing cached
+            # under the new version always includes them
+            self.db["meta"].update_one({"_id": "catalog_version"}, {"$inc": {"value": 1}}, upsert=True)
+
+    def _meta_value(self, key):
+        meta = self.db["meta"].find_one({"_id": key})
+        return meta["value"] if meta else 0
+
+    def catalog_version(self):
+        """Return a counter that changes whenever files are added."""
+        return self._meta_value("catalog_version")
+
+    def downloads_version(self):
+        """Return a counter that changes whenever a download is logged."""
+        return self._meta_value("downloads_version")
+
+    def list_hashes(self, since=None):
+        """
+        Return (hashes, cursor): every stored hash, or only those added
+        after the cursor of an earlier call was taken. Writes are not
+        ordered across clients, so the cursor reaches MONGO_CATCHUP_WINDOW
+        back and rows inserted around an earlier call are read again.
+        """
+        from bson import ObjectId
+        cursor = ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=MONGO_CATCHUP_WINDOW))
+        query = {"file_hash": {"$ne": None}}
+        if since is not None:
+            query["_id"] = {"$gte": since}
+        hashes = [document["file_hash"] for document in self.db["files"].find(query, {"_id": 0, "file_hash": 1})]
+        return hashes, cursor
+
+    def add_similarity_keys(self, file_hash, kind, keys):
+        """Index a file's near-duplicate signature under its bucket keys."""
+        self.db["similarity_keys"].insert_many(
+            [{"kind": kind, "key": key, "file_hash": file_hash} for key in keys]
+        )
+
+    def find_similarity_candidates(self, kind, keys):
+        """Return the hashes of files sharing at least one bucket key."""
+        return self.db["similarity_keys"].distinct("file_hash", {"kind": kind, "key": {"$in": list(keys)}})
+
+    def acquire_blob(self, file_hash, size):
+        """Add a reference to the content-addressed blob for file_hash."""
+        self.db["blobs"].update_one(
+            {"_id": file_hash}, {"$inc": {"ref_count": 1}, "$set": {"size": size}}, upsert=True
+        )
+
+    def release_blob(self, file_hash):
+        """Drop a reference to the blob and return how many remain."""
+        from pymongo import ReturnDocument
+        blob = self.db["blobs"].find_one_and_update(
+            {"_id": file_hash}, {"$inc": {"ref_count": -1}}, return_document=ReturnDocument.AFTER
+        )
+        if not blob:
+            return 0
+        if blob["ref_count"] <= 0:
+            self.db["blobs"].delete_one({"_id": file_hash, "ref_count": {"$lte": 0}})
+        return max(blob["ref_count"], 0)
+
+    def cache_url(self, url, file_hash, etag=None, last_modified=None, content_length=None):
+        """Remember the content and HTTP validators a URL just returned."""
+        self.db["url_cache"].update_one(
+            {"_id": url},
+            {"$set": {"file_hash": file_hash, "etag": etag, "last_modified": last_modified,
+                      "content_length": content_length, "fetched_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    def log_download(self, file_name, user_id):
+        """Log user downloads."""
+        self.db["downloads"].insert_one({
+            "file_name": file_name,
+            "user_id": user_id,
+            "timestamp": datetime.utcnow(),
+        })
+        self.db["meta"].update_one({"_id": "downloads_version"}, {"$inc": {"value": 1}}, upsert=True)
+
+    def has_downloaded(self, file_name, user_id):
+        """Check if the user has already downloaded the file."""
+        return self.db["downloads"].find_one(
+            {"file_name": file_name, "user_id": user_id}, {"_id": 1}
+        ) is not None
+
+    def list_files(self, limit=100, cursor=None, uploaded_by=None, file_type=None, since=None, until=None,
+                   prefix=None, search=None):
+        """
+        Return one page of files in insertion order and the cursor for the
+        next page (None on the last page). Filters combine with AND; search
+        matches every word of the query inside the file name.
+        """
+        from bson import ObjectId
+        query = {}
+        if cursor:
+            if not ObjectId.is_valid(cursor):
+                raise ValueError(f"Invalid cursor: {cursor}")
+            query["_id"] = {"$gt": ObjectId(cursor)}
+        if uploaded_by:
+            query["uploaded_by"] = uploaded_by
+        if file_type:
+            query["file_type"] = file_type.lower()
+        if since or until:
+            query["uploaded_at"] = {
+                **({"$gte": normalize_timestamp(since)} if since else {}),
+                **({"$lt": normalize_timestamp(until)} if until else {}),
+            }
+        name_patterns = []
+        if prefix:
+            name_patterns.append({"file_name": {"$regex": f"^{re.escape(prefix)}"}})
+        if search:
+            name_patterns.extend(
+                {"file_name": {"$regex": re.escape(word), "$options": "i"}}
+                for word in re.findall(r"\w+", search)
+            )
+        if name_patterns:
+            query["$and"] = name_patterns
+
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        projection = {"file_name": 1, "file_path": 1, "uploaded_by": 1, "file_size": 1, "file_type": 1,
+                      "uploaded_at": 1}
+        documents = list(self.db["files"].find(query, projection).sort("_id", 1).limit(limit + 1))
+        next_cursor = str(documents[limit - 1]["_id"]) if len(documents) > limit else None
+        files = []
+        for document in documents[:limit]:
+            document.pop("_id")
+            files.append(document)
+        return files, next_cursor
+
+    def list_downloaders(self, file_name):
+        """Return the user ID and timestamp of every download of the file."""
+        downloads = self.db["downloads"].find({"file_name": file_name}, {"_id": 0, "user_id": 1, "timestamp": 1})
+        return [
+            {"user_id": log.get("user_id"), "timestamp": log["timestamp"].isoformat() if log.get("timestamp") else None}
+            for log in downloads
+        ]
+
+    def create_job(self, job_id, file_url, user_id):
+        """Record a queued URL ingest job."""
+        now = datetime.utcnow()
+        self.db["ingest_jobs"].insert_one({
+            "_id": job_id, "file_url": file_url, "user_id": user_id, "status": "queued",
+            "bytes_received": 0, "result": None, "error": None, "created_at": now, "updated_at": now,
+        })
+
+    def update_job(self, job_id, **fields):
+        """Update status, bytes_received, result or error of an ingest job."""
+        update = {field: value for field, value in fields.items() if field in JOB_FIELDS}
+        update["updated_at"] = datetime.utcnow()
+        self.db["ingest_jobs"].update_one({"_id": job_id}, {"$set": update})
+
+    def get_job(self, job_id):
+        """Return an ingest job as a dict, or None."""
+        job = self.db["ingest_jobs"].find_one({"_id": job_id})
+        if not job:
+            return None
+        job["id"] = job.pop("_id")
+        for field in ("created_at", "updated_at"):
+            job[field] = job[field].isoformat() if job.get(field) else None
+        return job
+
+
+STORAGE_BACKENDS = {
+    "sqlite": SQLiteStorage,
+    "mongo": MongoStorage,
+}
+
+_storage = None
+
+
+def get_storage():
+    """Return the process-wide metadata backend selected by STORAGE_BACKEND."""
+    global _storage
+    if _storage is None:
+        try:
+            backend_class = STORAGE_BACKENDS[STORAGE_BACKEND]
+        except KeyError:
+            raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
+        _storage = _wrap(backend_class())
+    return _storage
+
+
+def set_storage(storage):
+    """
+    Replace the process-wide backend, e.g. with MongoStorage(mongomock_db).
+    It is instrumented and put behind the lookup cache like the default one.
+    """
+    global _storage
+    _storage = storage if isinstance(storage, (CachedStorage, InstrumentedStorage)) else _wrap(storage)
+
+
+def _wrap(storage):
+    # Timing sits below the cache so that only real backend calls are counted
+    if METRICS_ENABLED:
+        storage = InstrumentedStorage(storage)
+    if LOOKUP_CACHE_ENABLED:
+        storage = CachedStorage(storage)
+    return storage
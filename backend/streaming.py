@@ -0,0 +1,111 @@
+import hashlib
+import os
+import tempfile
+import time
+from metrics import record_hashing
+
+# Large chunks keep hashing and disk writes bound by I/O rather than by
+# per-call Python overhead.
+CHUNK_SIZE = 1024 * 1024
+
+
+class HashingSpoolFile:
+    """
+    Writable temporary file that hashes every byte as it is written.
+    The temp file lives in the destination directory so that keeping it is a
+    single atomic rename, and discarding it never touches the final path.
+    """
+
+    def __init__(self, directory, prefix=".incoming_"):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.name = tempfile.mkstemp(dir=directory, prefix=prefix)
+        self._file = os.fdopen(fd, "w+b", buffering=CHUNK_SIZE)
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.committed = False
+        # Hashing time and bytes not yet reported to metrics
+        self._hash_seconds = 0.0
+        self._hash_bytes = 0
+
+    def write(self, data):
+        started = time.perf_counter()
+        self._hash.update(data)
+        self._hash_seconds += time.perf_counter() - started
+        self._hash_bytes += len(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def _report_hashing(self):
+        if self._hash_bytes:
+            record_hashing(self._hash_bytes, self._hash_seconds)
+            self._hash_seconds = 0.0
+            self._hash_bytes = 0
+
+    def hexdigest(self):
+        """Return the SHA-256 of everything written so far."""
+        self._report_hashing()
+        return self._hash.hexdigest()
+
+    def commit(self, file_path):
+        """Atomically move the spooled bytes to file_path."""
+        self._report_hashing()
+        self._file.close()
+        os.replace(self.name, file_path)
+        self.name = file_path
+        self.committed = True
+
+    def discard(self):
+        """Close and delete the temp file unless it was committed."""
+        if self.committed:
+            return
+        self._report_hashing()
+        self._file.close()
+        try:
+            os.remove(self.name)
+        except FileNotFoundError:
+            pass
+
+    def __getattr__(self, attr):
+        # Werkzeug reads/seeks the container like a regular file object.
+        return getattr(self._file, attr)
+
+
+def spool_stream(source, directory):
+    """
+    Copy a readable stream into a HashingSpoolFile in one pass.
+    Returns the spool file; the caller must commit() or discard() it.
+    """
+    spool = HashingSpoolFile(directory)
+    try:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+            spool.write(chunk)
+        spool.flush()
+    except BaseException:
+        spool.discard()
+        raise
+    return spool
+
+
+# Size of each block sampled for the cheap pre-flight fingerprint. The
+# frontend computes the same value in the browser, so keep them in sync.
+SAMPLE_SIZE = 64 * 1024
+
+
+def sample_fingerprint(file_path, file_size=None):
+    """
+    Cheap fingerprint of a file: SHA-256 over "<size>:" followed by the
+    first, middle and last SAMPLE_SIZE blocks (or the whole file when it
+    is smaller than three blocks). Equal fingerprints only make a file a
+    duplicate candidate; the full hash confirms it.
+    """
+    if file_size is None:
+        file_size = os.path.getsize(file_path)
+    sample_hash = hashlib.sha256(f"{file_size}:".encode("ascii"))
+    with open(file_path, "rb") as f:
+        if file_size <= 3 * SAMPLE_SIZE:
+            sample_hash.update(f.read())
+        else:
+            for offset in (0, (file_size - SAMPLE_SIZE) // 2, file_size - SAMPLE_SIZE):
+                f.seek(offset)
+                sample_hash.update(f.read(SAMPLE_SIZE))
+    return sample_hash.hexdigest()
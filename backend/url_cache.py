@@ -0,0 +1,72 @@
+import re
+import urllib.parse
+
+# Query parameters that only track where a link was shared and never change
+# the content behind it.
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "mc_cid", "mc_eid", "_ga", "igshid", "usp"}
+TRACKING_PREFIXES = ("utm_",)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def _drive_file_id(parsed):
+    match = re.search(r"/file/d/([^/]+)", parsed.path)
+    if match:
+        return match.group(1)
+    if parsed.path in ("/open", "/uc"):
+        file_ids = urllib.parse.parse_qs(parsed.query).get("id")
+        if file_ids:
+            return file_ids[0]
+    return None
+
+
+def normalize_url(file_url):
+    """
+    Return the cache key for a download URL. Google Drive share, open and
+    download links collapse to one canonical download URL; otherwise the
+    scheme and host are lowercased, default ports, fragments and tracking
+    parameters dropped, and the remaining query parameters sorted.
+    """
+    parsed = urllib.parse.urlsplit(file_url.strip())
+    scheme = parsed.scheme.lower()
+    host = (parsed.hostname or "").lower()
+
+    if host == "drive.google.com":
+        file_id = _drive_file_id(parsed)
+        if file_id:
+            return f"https://drive.google.com/uc?export=download&id={file_id}"
+
+    netloc = host
+    if parsed.port and parsed.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{host}:{parsed.port}"
+    if parsed.username:
+        netloc = f"{parsed.username}{':' + parsed.password if parsed.password else ''}@{netloc}"
+
+    query = sorted(
+        (key, value)
+        for key, value in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS and not key.lower().startswith(TRACKING_PREFIXES)
+    )
+    return urllib.parse.urlunsplit(
+        (scheme, netloc, parsed.path or "/", urllib.parse.urlencode(query), "")
+    )
+
+
+def conditional_headers(record):
+    """Build If-None-Match / If-Modified-Since headers from a stored record."""
+    headers = {}
+    if record.get("etag"):
+        headers["If-None-Match"] = record["etag"]
+    if record.get("last_modified"):
+        headers["If-Modified-Since"] = record["last_modified"]
+    return headers
+
+
+def response_validators(response):
+    """Extract the validators worth storing from an HTTP response."""
+    content_length = response.headers.get("Content-Length")
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "content_length": int(content_length) if content_length and content_length.isdigit() else None,
+    }
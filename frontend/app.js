@@ -21,19 +21,169 @@ tabLinks.forEach(link => {
 document.querySelector(".tab-link").classList.add("active");
 document.querySelector(".tab-pane").classList.add("active");
 
+// Pre-flight duplicate check. Must match streaming.sample_fingerprint on the server.
+const SAMPLE_SIZE = 64 * 1024;
+// Larger files are not hashed in the browser; the server still catches duplicates.
+const MAX_CLIENT_HASH_SIZE = 256 * 1024 * 1024;
+
+async function sha256Hex(blob) {
+    const digest = await crypto.subtle.digest("SHA-256", await blob.arrayBuffer());
+    return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, "0")).join("");
+}
+
+async function sampleFingerprint(file) {
+    const size = file.size;
+    const parts = [`${size}:`];
+    if (size <= 3 * SAMPLE_SIZE) {
+        parts.push(file);
+    } else {
+        for (const offset of [0, Math.floor((size - SAMPLE_SIZE) / 2), size - SAMPLE_SIZE]) {
+            parts.push(file.slice(offset, offset + SAMPLE_SIZE));
+        }
+    }
+    return sha256Hex(new Blob(parts));
+}
+
+async function postCheck(payload) {
+    const response = await fetch("/check", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify(payload),
+    });
+    return response.json();
+}
+
+// Returns the server's duplicate verdict, or null if the file should just be uploaded.
+async function preflightDuplicate(file) {
+    if (!window.crypto || !crypto.subtle) {
+        return null;
+    }
+    try {
+        const sampleHash = await sampleFingerprint(file);
+        let result = await postCheck({ file_size: file.size, sample_hash: sampleHash });
+        if (result.status === "candidate" && file.size <= MAX_CLIENT_HASH_SIZE) {
+            result = await postCheck({ file_hash: await sha256Hex(file) });
+        }
+        return result.status === "duplicate" ? result : null;
+    } catch (error) {
+        console.error("Pre-flight check failed:", error);
+        return null;
+    }
+}
+
+// Files dropped onto the drop zone, used instead of the file input when present
+let droppedFiles = [];
+
+// Recursively collect files from a dropped file or folder entry
+async function collectEntryFiles(entry) {
+    if (entry.isFile) {
+        return [await new Promise((resolve, reject) => entry.file(resolve, reject))];
+    }
+    const reader = entry.createReader();
+    const files = [];
+    let batch;
+    // readEntries returns at most ~100 entries per call, so read until empty
+    do {
+        batch = await new Promise((resolve, reject) => reader.readEntries(resolve, reject));
+        for (const child of batch) {
+            files.push(...await collectEntryFiles(child));
+        }
+    } while (batch.length > 0);
+    return files;
+}
+
+const dropZone = document.getElementById("dropZone");
+dropZone.addEventListener("dragover", (e) => {
+    e.preventDefault();
+    dropZone.classList.add("dragover");
+});
+dropZone.addEventListener("dragleave", () => dropZone.classList.remove("dragover"));
+dropZone.addEventListener("drop", async (e) => {
+    e.preventDefault();
+    dropZone.classList.remove("dragover");
+    const entries = Array.from(e.dataTransfer.items)
+        .map(item => item.webkitGetAsEntry && item.webkitGetAsEntry())
+        .filter(Boolean);
+    droppedFiles = entries.length > 0
+        ? (await Promise.all(entries.map(collectEntryFiles))).flat()
+        : Array.from(e.dataTransfer.files);
+    dropZone.textContent = `${droppedFiles.length} file(s) ready to upload`;
+});
+
+const DROP_ZONE_TEXT = dropZone.textContent;
+
+// Dropped files are used for one submit only; choosing files replaces them
+function clearDroppedFiles() {
+    droppedFiles = [];
+    dropZone.textContent = DROP_ZONE_TEXT;
+}
+document.getElementById("file").addEventListener("change", clearDroppedFiles);
+
+async function uploadBatch(files, userId) {
+    const formData = new FormData();
+    formData.append("user_id", userId);
+    files.forEach(file => formData.append("files", file));
+
+    const response = await fetch("/upload_batch", {
+        method: "POST",
+        body: formData
+    });
+
+    const result = await response.json();
+    document.getElementById("uploadResponse").textContent = JSON.stringify(result, null, 2);
+    if (result.error) {
+        alert(result.error);
+    } else {
+        alert(`${result.uploaded} uploaded, ${result.duplicates} duplicate(s) detected`);
+    }
+}
+
 // Upload Form Event Listener
 document.getElementById("uploadForm").addEventListener("submit", async (e) => {
     e.preventDefault();
     const formData = new FormData(e.target);
+    const files = droppedFiles.length > 0 ? droppedFiles : Array.from(document.getElementById("file").files);
+    clearDroppedFiles();
+
+    if (files.length === 0) {
+        alert("Please choose or drop at least one file.");
+        return;
+    }
+    if (files.length > 1) {
+        await uploadBatch(files, formData.get("user_id"));
+        return;
+    }
+    formData.set("file", files[0]);
+
+    const duplicate = await preflightDuplicate(files[0]);
+    if (duplicate) {
+        document.getElementById("uploadResponse").textContent = JSON.stringify(duplicate, null, 2);
+        alert(`Duplicate detected. Uploaded by user ID: ${duplicate.uploaded_by}`);
+        return;
+    }
 
-    const response = await fetch("/upload", { 
+    let response = await fetch("/upload", { 
         method: "POST", 
         body: formData 
     });
 
-    const result = await response.json();
+    let result = await response.json();
     document.getElementById("uploadResponse").textContent = JSON.stringify(result, null, 2);
 
+    if (result.message === "Near-duplicate file detected") {
+        const uploadAnyway = confirm(
+            `This file looks like "${result.similar_to}" (similarity ${result.similarity}), ` +
+            `uploaded by user ID: ${result.uploaded_by}. Upload it anyway?`
+        );
+        if (!uploadAnyway) {
+            return;
+        }
+        formData.set("allow_near_duplicate", "true");
+        response = await fetch("/upload", { method: "POST", body: formData });
+        result = await response.json();
+        document.getElementById("uploadResponse").textContent = JSON.stringify(result, null, 2);
+    }
+
     if (result.message === "Duplicate file detected") {
         alert(`Duplicate detected. Uploaded by user ID: ${result.uploaded_by}`);
     } else {
@@ -60,21 +210,18 @@ document.getElementById("downloadNameForm").addEventListener("submit", async (e)
         });
 
         if (response.status === 200) {
-            const contentDisposition = response.headers.get("Content-Disposition");
+            const result = await response.json();
 
-            if (contentDisposition && contentDisposition.includes("attachment")) {
-                const blob = await response.blob();
-                const url = window.URL.createObjectURL(blob);
+            if (result.download_url) {
+                // Let the browser stream the file to disk (and resume it) natively
                 const a = document.createElement("a");
-                a.href = url;
+                a.href = result.download_url;
                 a.download = fileName;
                 document.body.appendChild(a);
                 a.click();
                 a.remove();
-                window.URL.revokeObjectURL(url);
-                alert("File downloaded successfully!");
+                document.getElementById("downloadNameResponse").textContent = "Download started.";
             } else {
-                const result = await response.json();
                 document.getElementById("downloadNameResponse").textContent = JSON.stringify(result, null, 2);
             }
         } else {
@@ -87,6 +234,31 @@ document.getElementById("downloadNameForm").addEventListener("submit", async (e)
     }
 });
 
+// Poll a background ingest job until it finishes and return its final response
+const JOB_POLL_INTERVAL = 1000;
+// Give up on a job that has not finished after this long, e.g. one lost to a server restart
+const JOB_POLL_TIMEOUT = 30 * 60 * 1000;
+
+async function pollJob(statusUrl, progressElement) {
+    const deadline = Date.now() + JOB_POLL_TIMEOUT;
+    while (Date.now() < deadline) {
+        const response = await fetch(statusUrl);
+        const job = await response.json();
+        if (!response.ok) {
+            return job;
+        }
+        if (job.status === "done") {
+            return job.result;
+        }
+        if (job.status === "failed") {
+            return { error: job.error };
+        }
+        progressElement.textContent = `Job ${job.status}: ${job.bytes_received || 0} bytes received`;
+        await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL));
+    }
+    return { error: "Timed out waiting for the download job to finish" };
+}
+
 // Handle downloading from URL
 document.getElementById("downloadUrlForm").addEventListener("submit", async (e) => {
     e.preventDefault();
@@ -105,7 +277,10 @@ document.getElementById("downloadUrlForm").addEventListener("submit", async (e)
             body: JSON.stringify({ file_url: fileUrl, user_id: userId }),
         });
 
-        const result = await response.json();
+        let result = await response.json();
+        if (response.status === 202) {
+            result = await pollJob(result.status_url, document.getElementById("downloadUrlResponse"));
+        }
 
         // Exclude the "users" field from the alert
         const { users, ...filteredResult } = result;
@@ -119,30 +294,50 @@ document.getElementById("downloadUrlForm").addEventListener("submit", async (e)
 });
 
 
-// Get files from the server
-document.getElementById("getFilesButton").addEventListener("click", async () => {
+// Get files from the server, one page at a time
+let nextFilesCursor = null;
+
+function renderFiles(files) {
+    return files.map(file => 
+        `<div>
+            <strong>${file.file_name}</strong><br>
+            Path: ${file.file_path}<br>
+            Uploaded by: ${file.uploaded_by}<br>
+            <hr>
+        </div>`).join('');
+}
+
+async function loadFiles(append) {
+    const params = new URLSearchParams();
+    const search = document.getElementById("searchFiles").value.trim();
+    const uploader = document.getElementById("filterUploader").value.trim();
+    if (search) params.set("q", search);
+    if (uploader) params.set("uploaded_by", uploader);
+    if (append && nextFilesCursor) params.set("cursor", nextFilesCursor);
+
     try {
-        const response = await fetch("/get_files", { method: "GET" });
+        const response = await fetch(`/get_files?${params}`, { method: "GET" });
 
         const result = await response.json();
         
         const filesListDiv = document.getElementById("filesList");
-        filesListDiv.innerHTML = '';
+        if (!append) {
+            filesListDiv.innerHTML = '';
+        }
 
         if (result.files && result.files.length > 0) {
-            const fileListHtml = result.files.map(file => 
-                `<div>
-                    <strong>${file.file_name}</strong><br>
-                    Path: ${file.file_path}<br>
-                    Uploaded by: ${file.uploaded_by}<br>
-                    <hr>
-                </div>`).join('');
-            filesListDiv.innerHTML = fileListHtml;
-        } else {
+            filesListDiv.insertAdjacentHTML("beforeend", renderFiles(result.files));
+        } else if (!append) {
             filesListDiv.innerHTML = '<p>No files found in the database.</p>';
         }
+
+        nextFilesCursor = result.next_cursor;
+        document.getElementById("loadMoreButton").style.display = nextFilesCursor ? "inline-block" : "none";
     } catch (error) {
         console.error("Error fetching files:", error);
         alert("An error occurred while fetching the files.");
     }
-});
+}
+
+document.getElementById("getFilesButton").addEventListener("click", () => loadFiles(false));
+document.getElementById("loadMoreButton").addEventListener("click", () => loadFiles(true));